@@ -1,17 +1,91 @@
+import math
+import time
 from threaded_worker import ThreadedWorker
 
 class BatchingWorker(ThreadedWorker):
-    def __init__(self, settings):
+    def __init__(self, settings, worker_stats=None):
         super().__init__()
         self.settings = settings
-        
+        self.worker_stats = worker_stats
+        self.update_interval = 1
+        self.alpha = 0.1
+
     def setup(self):
         self.batch = []
-        
+        self.batch_start = None
+        self.batch_size = self.settings.batch_size
+        self.last_update = time.time()
+        self.last_arrival = None
+        self.frame_interval = 1 / self.settings.fps
+
+    @property
+    def adaptive(self):
+        return self.settings.batch_mode == "adaptive"
+
+    def update_batch_size(self):
+        settings = self.settings
+        fps = 1 / self.frame_interval
+        workers = self.worker_stats.active() if self.worker_stats else []
+        if not workers:
+            self.batch_size = settings.batch_size
+            return
+        # from the same list, a worker may time out between two clock reads
+        round_trip = sum(self.worker_stats.round_trip(i) for i in workers) / len(workers)
+        # smallest batch that lets the active workers keep up with the input
+        target = math.ceil(fps * round_trip / len(workers))
+        target = min(max(target, settings.batch_min), settings.batch_max)
+        # move one step at a time, the round trip depends on the batch size
+        if target > self.batch_size:
+            self.batch_size += 1
+        elif target < self.batch_size:
+            self.batch_size -= 1
+        self.batch_size = min(max(self.batch_size, settings.batch_min), settings.batch_max)
+
+    def max_wait(self):
+        if self.settings.batch_max_wait > 0:
+            return self.settings.batch_max_wait
+        # the wait starts at the first frame, so the other batch_size - 1 frames
+        # should arrive within this, with one frame interval of slack
+        return self.batch_size * self.frame_interval
+
+    def flush(self, n):
+        batch = self.batch[:n]
+        self.batch = self.batch[n:]
+        self.batch_start = time.time() if self.batch else None
+        return batch
+
     def work(self, input):
+        if not self.adaptive:
+            self.batch.append(input)
+            n = self.settings.batch_size
+            if len(self.batch) >= n:
+                return self.flush(n)
+            return
+
+        now = time.time()
+        if self.last_arrival is not None:
+            interval = now - self.last_arrival
+            if interval < 1: # ignore pauses in the input
+                self.frame_interval += self.alpha * (interval - self.frame_interval)
+        self.last_arrival = now
+        if now - self.last_update > self.update_interval:
+            self.update_batch_size()
+            self.last_update = now
+
+        if not self.batch:
+            self.batch_start = now
         self.batch.append(input)
-        n = self.settings.batch_size
-        if len(self.batch) >= n:
-            batch = self.batch[:n]
-            self.batch = self.batch[n:]
-            return batch
\ No newline at end of file
+        if len(self.batch) >= self.batch_size:
+            return self.flush(self.batch_size)
+        return self.idle()
+
+    # flush a partial batch when the oldest frame has waited too long
+    def idle(self):
+        if not self.adaptive or not self.batch:
+            self.input_timeout = 0.1
+            return
+        remaining = self.batch_start + self.max_wait() - time.time()
+        if remaining <= 0:
+            self.input_timeout = 0.1
+            return self.flush(len(self.batch))
+        self.input_timeout = min(remaining, 0.1)
@@ -0,0 +1,70 @@
+import time
+import random
+from fixed_size_dict import FixedSizeDict
+from reorder_buffer import ReorderBuffer
+
+# compares the old FixedSizeDict reordering with ReorderBuffer on a stream
+# of frames that arrive shuffled within batches from several workers
+
+def make_arrivals(n, batch_size=4, workers=4, seed=0):
+    rng = random.Random(seed)
+    arrivals = []
+    window = batch_size * workers
+    for start in range(0, n, window):
+        batches = [
+            list(range(i, min(i + batch_size, n)))
+            for i in range(start, min(start + window, n), batch_size)
+        ]
+        rng.shuffle(batches)
+        for batch in batches:
+            arrivals.extend(batch)
+    return arrivals
+
+
+def run_fixed_size_dict(arrivals):
+    msg_buffer = FixedSizeDict(100)
+    next_index = 0
+    emitted = 0
+    for index in arrivals:
+        msg_buffer[index] = {"index": index, "jpg": b""}
+        while next_index in msg_buffer:
+            msg = msg_buffer[next_index]
+            del msg_buffer[next_index]
+            next_index += 1
+            emitted += 1
+    return emitted
+
+
+def run_reorder_buffer(arrivals):
+    msg_buffer = ReorderBuffer(128)
+    next_index = 0
+    emitted = 0
+    for index in arrivals:
+        msg_buffer.put(index, {"index": index, "jpg": b""}, next_index)
+        msg = msg_buffer.pop(next_index)
+        while msg is not None:
+            next_index += 1
+            emitted += 1
+            msg = msg_buffer.pop(next_index)
+    return emitted
+
+
+def benchmark(fn, arrivals, repeats=5):
+    best = None
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        emitted = fn(arrivals)
+        duration = time.perf_counter() - start_time
+        best = duration if best is None else min(best, duration)
+    return best, emitted
+
+
+if __name__ == "__main__":
+    n = 200000
+    arrivals = make_arrivals(n)
+    for name, fn in [
+        ("FixedSizeDict", run_fixed_size_dict),
+        ("ReorderBuffer", run_reorder_buffer),
+    ]:
+        duration, emitted = benchmark(fn, arrivals)
+        print(f"{name}: {1e9 * duration / n:.0f}ns per frame, {emitted}/{n} emitted")
@@ -0,0 +1,73 @@
+import collections
+import queue
+import time
+
+POLICIES = ["block", "drop_oldest", "drop_newest"]
+
+
+# queue.Queue with a policy for what happens when it is full,
+# and counters for drops, high-water mark, blocking and wait time
+class BoundedQueue(queue.Queue):
+    def __init__(self, maxsize=0, policy="block"):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy}")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.name = None
+        self.drops = 0
+        self.high_water = 0
+        self.blocked_time = 0
+        self.wait_time = 0
+        self.last_wait = 0
+        self.count = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == "block":
+            start_time = time.time()
+            super().put(item, block, timeout)
+            self.blocked_time += time.time() - start_time
+            return
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self.drops += 1
+                if self.policy == "drop_newest":
+                    return
+                self.queue.popleft()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def clear(self):
+        with self.mutex:
+            self.queue.clear()
+            self.unfinished_tasks = 0
+            self.not_full.notify_all()
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "size": self._qsize(),
+                "maxsize": self.maxsize,
+                "policy": self.policy,
+                "drops": self.drops,
+                "high_water": self.high_water,
+                "blocked_time": self.blocked_time,
+                "wait_time": self.wait_time,
+                "count": self.count,
+            }
+
+    # items are stored with their enqueue time to measure the wait
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+
+    def _put(self, item):
+        self.queue.append((time.time(), item))
+        self.high_water = max(self.high_water, len(self.queue))
+
+    def _get(self):
+        put_time, item = self.queue.popleft()
+        self.last_wait = time.time() - put_time
+        self.wait_time += self.last_wait
+        self.count += 1
+        return item
@@ -0,0 +1,131 @@
+import time
+import threading
+import cv2
+import numpy as np
+from turbojpeg import TJSAMP_444, TJSAMP_422, TJSAMP_420, TJSAMP_GRAY, TJSAMP_440, TJSAMP_411
+from metrics import metrics
+from sequence_pack import open_sequence
+
+# mcu width and height per chroma subsampling. lossless crops have to
+# start on an mcu boundary.
+MCU_SIZE = {
+    TJSAMP_444: (8, 8),
+    TJSAMP_422: (16, 8),
+    TJSAMP_420: (16, 16),
+    TJSAMP_GRAY: (8, 8),
+    TJSAMP_440: (8, 16),
+    TJSAMP_411: (32, 8),
+}
+
+
+# v4l2 capture. with mjpeg, the camera's jpg buffers are returned as they
+# are instead of being decoded to bgr.
+class CameraCapture:
+    def __init__(self, width=1920, height=1080, fps=30, mjpeg=True):
+        self.mjpeg = mjpeg
+        self.cap = cv2.VideoCapture(-1, cv2.CAP_V4L2)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if mjpeg:
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+    # returns a jpg with mjpeg, a bgr frame otherwise, or None
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret or frame is None or frame.size == 0:
+            return None
+        if self.mjpeg:
+            return frame.tobytes()
+        return frame
+
+    def release(self):
+        self.cap.release()
+
+
+# fake camera that plays jpgs from a directory or packed sequence in a loop
+class FileCapture:
+    def __init__(self, directory, fps=30, mjpeg=True):
+        self.sequence = open_sequence(directory, fps)
+        self.fps = fps
+        self.mjpeg = mjpeg
+        self.frame_number = 0
+        self.next_frame_time = time.monotonic()
+
+    def read(self):
+        self.next_frame_time += 1 / self.fps
+        sleep_time = self.next_frame_time - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        encoded = self.sequence[self.frame_number % len(self.sequence)]
+        self.frame_number += 1
+        if self.mjpeg:
+            return encoded
+        return cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR)
+
+    def release(self):
+        self.sequence.close()
+
+
+# reads the capture on its own thread and keeps only the latest frame, so
+# a slow consumer gets the newest frame instead of a queue of stale ones
+class LatestFrameGrabber:
+    def __init__(self, capture, name="LatestFrameGrabber"):
+        self.capture = capture
+        self.name = name
+        self.condition = threading.Condition()
+        self.frame = None
+        self.timestamp = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                frame = self.capture.read()
+            except Exception as e:
+                # keep grabbing, the camera may come back
+                print(self.name, "capture error", repr(e))
+                metrics.count(self.name, "read_errors")
+                time.sleep(0.1)
+                continue
+            if frame is None:
+                # a disconnected camera fails right away, don't spin on it
+                metrics.count(self.name, "read_failures")
+                time.sleep(0.01)
+                continue
+            timestamp = time.time()
+            with self.condition:
+                if self.frame is not None:
+                    metrics.count(self.name, "skipped_frames")
+                self.frame = frame
+                self.timestamp = timestamp
+                self.condition.notify()
+
+    # returns the timestamp and the newest frame not returned yet, or None
+    def get(self, timeout=0.1):
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            if self.frame is None:
+                return None
+            frame, self.frame = self.frame, None
+            return self.timestamp, frame
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.capture.release()
+
+
+# crop a jpg without decoding it, the crop is moved to the mcu grid
+def lossless_crop(jpeg, encoded, x, y, width, height):
+    image_width, image_height, subsample, _ = jpeg.decode_header(encoded)
+    mcu_width, mcu_height = MCU_SIZE.get(subsample, (16, 16))
+    x -= x % mcu_width
+    y -= y % mcu_height
+    width = min(width, image_width - x)
+    height = min(height, image_height - y)
+    return jpeg.crop(encoded, x, y, width, height)
@@ -1,25 +1,122 @@
+import os
 import re
+import functools
+import threading
 import numpy as np
 import time
-from fixed_seed import fix_seed
-
-from sfast.compilers.stable_diffusion_pipeline_compiler import (
-    compile,
-    CompilationConfig,
-)
-
-from diffusers.utils.logging import disable_progress_bar
-from diffusers import AutoPipelineForImage2Image, AutoencoderTiny
 import torch
 import warnings
 
-from compel import Compel, ReturnedEmbeddingsType
+from embedding_cache import EmbeddingCache
 from fixed_size_dict import FixedSizeDict
+from pinned_buffers import PinnedBufferPool, normalize, quantize, to_host
+from shape_buckets import ShapeBuckets, parse_buckets, fit
+from utils.itertools import chunks
+from pipelined_executor import PipelinedExecutor, gather
+
+# startup states, in order. diffusers, sfast and compel are only imported
+# when loading starts, so a worker can connect and report its state first.
+# "failed" is set by the owner when loading raises.
+STATES = ["starting", "loading", "compiling", "warming", "warm", "failed"]
+
+# legacy blend strings like ("a", "b", "c").blend(0.30, 0.50, 0.20), parsed
+# once per string. anything else, including mismatched counts, is a prompt.
+@functools.lru_cache(maxsize=256)
+def parse_blend(prompt):
+    pattern = r'\(((?:\s*"[^"]*"\s*,?)+)\)\.blend\(([^)]*)\)'
+    match = re.search(pattern, prompt)
+    if not match:
+        return None
+    prompts = tuple(re.findall(r'"([^"]*)"', match.group(1)))
+    try:
+        weights = tuple(float(e) for e in match.group(2).split(","))
+    except ValueError:
+        return None
+    if len(prompts) != len(weights):
+        return None
+    return prompts, weights
+
+# joins the results of a split batch
+def concat(results):
+    if len(results) == 1:
+        return results[0]
+    if isinstance(results[0], np.ndarray):
+        return np.concatenate(results)
+    return torch.cat(results)
 
 class DiffusionProcessor:
-    def __init__(self, warmup=None, local_files_only=True):
+    def __init__(
+        self,
+        warmup=None,
+        local_files_only=True,
+        embedding_cache_size=32,
+        embedding_cache_dir=None,
+        prewarm_prompts=None,
+        embedding_remote=None,
+        shape_buckets=None,
+        pipelined=False,
+        compile_cache_dir=None,
+        lazy=False,
+        on_state=None,
+        device="cuda",
+    ):
+        self.warmup = warmup
+        self.local_files_only = local_files_only
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache_dir = embedding_cache_dir
+        self.prewarm_prompts = prewarm_prompts
+        self.embedding_remote = embedding_remote
+        self.shape_buckets = shape_buckets
+        self.pipelined = pipelined
+        self.compile_cache_dir = compile_cache_dir
+        self.on_state = on_state
+        # a stand-in pipe on the cpu can replace the model in tests
+        self.device = device
+        self.state = "starting"
+        self.timings = {}
+        self.buckets = None
+        self.executor = None
+        # runs are serialized, warmup may run in the background. the
+        # pipelined vae stages only take vae_lock, so they overlap the unet
+        # but not a run, which may be capturing a new shape.
+        self.lock = threading.Lock()
+        self.vae_lock = threading.Lock()
+        # with lazy, load() is called by the owner, usually on another thread
+        if not lazy:
+            self.load()
+
+    @property
+    def ready(self):
+        return self.state == "warm"
+
+    def set_state(self, state):
+        now = time.time()
+        if hasattr(self, "state_time"):
+            self.timings[self.state] = now - self.state_time
+        self.state_time = now
+        self.state = state
+        print("DiffusionProcessor", state, flush=True)
+        if self.on_state is not None:
+            self.on_state(state)
+
+    def load(self):
+        self.set_state("loading")
+        if self.compile_cache_dir is not None:
+            # triton kernels compiled by sfast are reused across restarts
+            os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(self.compile_cache_dir, "triton"))
+
+        from sfast.compilers.stable_diffusion_pipeline_compiler import (
+            compile,
+            CompilationConfig,
+        )
+        from diffusers.utils.logging import disable_progress_bar
+        from diffusers import AutoPipelineForImage2Image, AutoencoderTiny
+        from compel import Compel, ReturnedEmbeddingsType
+        from fixed_seed import fix_seed
+
         base_model = "stabilityai/sdxl-turbo"
         vae_model = "madebyollin/taesdxl"
+        local_files_only = self.local_files_only
 
         warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
 
@@ -37,6 +134,7 @@ class DiffusionProcessor:
         fix_seed(self.pipe)
 
         print("Model loaded")
+        self.set_state("compiling")
 
         config = CompilationConfig.Default()
         config.enable_xformers = True
@@ -46,7 +144,7 @@ class DiffusionProcessor:
 
         print("Model compiled")
 
-        self.pipe.to(device="cuda", dtype=torch.float16)
+        self.pipe.to(device=self.device, dtype=torch.float16)
         self.pipe.set_progress_bar_config(disable=True)
 
         print("Model moved to GPU", flush=True)
@@ -57,14 +155,29 @@ class DiffusionProcessor:
             returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
             requires_pooled=[False, True],
         )
-        self.prompt_cache = FixedSizeDict(32)
+        self.embeddings = EmbeddingCache(
+            self.compel,
+            base_model,
+            self.embedding_cache_size,
+            self.embedding_cache_dir,
+            device=self.device,
+            remote=self.embedding_remote,
+        )
+        self.last_embedding = None
+        self.blend_endpoints = FixedSizeDict(8)
         print("Prepared compel")
 
         self.generator = torch.manual_seed(0)
+        self.output_buffers = PinnedBufferPool()
+
+        self.set_state("warming")
+        if self.prewarm_prompts:
+            self.embeddings.prewarm(self.prewarm_prompts)
         
+        warmup = self.warmup
         if warmup:
             warmup_shape = [int(e) for e in warmup.split("x")]
-            images = np.zeros(warmup_shape, dtype=np.float32)
+            images = np.zeros(warmup_shape, dtype=np.uint8)
             for i in range(2):
                 print(f"Warmup {warmup} {i+1}/2")
                 start_time = time.time()
@@ -72,51 +185,252 @@ class DiffusionProcessor:
                     images,
                     prompt="warmup",
                     num_inference_steps=2,
-                    strength=1.0
+                    strength=1.0,
+                    output="uint8",
+                    bucket=False,
                 )
             print("Warmup finished", flush=True)
+
+        if self.shape_buckets:
+            self.buckets = ShapeBuckets(parse_buckets(self.shape_buckets))
+            if warmup and tuple(warmup_shape[:3]) in self.buckets.shapes:
+                self.buckets.warm.add(tuple(warmup_shape[:3]))
+            threading.Thread(target=self.warmup_buckets, daemon=True).start()
+
+        if self.pipelined:
+            self.executor = PipelinedExecutor(
+                [self.encode_stage, self.denoise_stage, self.decode_stage], self.device
+            )
+
+        self.set_state("warm")
+        timings = ", ".join(f"{k} {v:.1f}s" for k, v in self.timings.items())
+        print(f"DiffusionProcessor startup: {timings}", flush=True)
+
+    def warmup_buckets(self):
+        for shape in self.buckets.shapes:
+            if shape in self.buckets.warm:
+                continue
+            images = np.zeros((*shape, 3), dtype=np.uint8)
+            for i in range(2):
+                print(f"Warmup bucket {'x'.join(map(str, shape))} {i+1}/2")
+                self.run(
+                    images,
+                    prompt="warmup",
+                    num_inference_steps=2,
+                    strength=1.0,
+                    output="uint8",
+                    bucket=False,
+                )
+            self.buckets.warm.add(shape)
+        print("Bucket warmup finished", flush=True)
             
-    def embed_prompt(self, prompt):
-        if prompt not in self.prompt_cache:
-            with torch.no_grad():
-                print("embedding prompt", prompt)
-                self.prompt_cache[prompt] = self.compel(prompt)
-        return self.prompt_cache[prompt]
+    # returns None while the prompt is embedded in the background
+    def embed_prompt(self, prompt, block=False):
+        return self.embeddings.get(prompt, block)
     
-    def meta_embed_prompt(self, prompt):
-        pattern = r'\("(.*?)"\s*,\s*"(.*?)"\)\.blend\((.*?),(.*?)\)'
-        match = re.search(pattern, prompt)
-        if not match:
-            return self.embed_prompt(prompt)
-        str1, str2, t1, t2 = match.groups()
-        t1 = float(t1)
-        t2 = float(t2)
-        cond1, pool1 = self.embed_prompt(str1)
-        cond2, pool2 = self.embed_prompt(str2)
-        cond = cond1 * t1 + cond2 * t2
-        pool = pool1 * t1 + pool2 * t2
+    def meta_embed_prompt(self, prompt, block=False):
+        blend = parse_blend(prompt)
+        if blend is None:
+            return self.embed_prompt(prompt, block)
+        return self.blend_prompts(*blend, block=block)
+
+    # weighted sum of any number of prompts. the endpoint embeddings are
+    # stacked once per prompt list, so changing the weights only costs one
+    # tensordot on the gpu.
+    def blend_prompts(self, prompts, weights, block=False):
+        prompts = tuple(prompts)
+        if prompts not in self.blend_endpoints:
+            embeddings = [self.embed_prompt(prompt, block) for prompt in prompts]
+            if any(e is None for e in embeddings):
+                return None
+            conds, pools = zip(*embeddings)
+            self.blend_endpoints[prompts] = (torch.stack(conds), torch.stack(pools))
+        conds, pools = self.blend_endpoints[prompts]
+        weights = torch.tensor(weights, dtype=conds.dtype, device=conds.device)
+        cond = torch.tensordot(weights, conds, dims=1)
+        pool = torch.tensordot(weights, pools, dims=1)
         return cond, pool
+
+    def embed(self, prompt, blend_prompts=None, blend_weights=None, block=False):
+        # the lists are updated separately, ignore them while they disagree
+        if blend_prompts and len(blend_prompts) == len(blend_weights):
+            return self.blend_prompts(blend_prompts, blend_weights, block)
+        return self.meta_embed_prompt(prompt, block)
     
-    def run(self, images, prompt, num_inference_steps, strength, use_compel=False, seed=None):
+    # output is "float" for float32 numpy arrays in [0, 1], "uint8" for uint8
+    # numpy arrays in pinned host memory, or "uint8_device" for a uint8 NHWC
+    # tensor that stays on the gpu. blend_prompts and blend_weights replace
+    # the prompt when use_compel is set. with shape buckets, uint8 batches
+    # are padded or cropped to a warm bucket, and split if they are larger.
+    def run(self, images, *args, bucket=True, **kwargs):
+        with self.lock, self.vae_lock:
+            if not bucket:
+                return self.diffuse(images, *args, **kwargs)
+            results = [
+                self.diffuse(batch, *args, **kwargs, count=count, crop=crop)
+                for batch, count, crop in self.split(images)
+            ]
+            return concat(results)
+
+    # fits the batch to a warm bucket, in bucket sized pieces if it is
+    # larger. yields the pieces with the count and crop to undo the fit.
+    def split(self, images):
+        shape = None
+        if self.buckets is not None and isinstance(images, np.ndarray):
+            shape = self.buckets.choose(*images.shape[:3])
+        if shape is None:
+            yield images, None, None
+            return
+        crop = (min(images.shape[1], shape[1]), min(images.shape[2], shape[2]))
+        for batch in chunks(images, shape[0]):
+            yield fit(batch, shape), len(batch), crop
+
+    def diffuse(
+        self,
+        images,
+        prompt,
+        num_inference_steps,
+        strength,
+        use_compel=False,
+        seed=None,
+        output="float",
+        blend_prompts=None,
+        blend_weights=None,
+        count=None,
+        crop=None,
+    ):
+        images = self.prepare_images(images)
         strength = min(max(1 / num_inference_steps, strength), 1)
         if seed is not None:
             self.generator = torch.manual_seed(seed)
-        kwargs = {}
-        if use_compel:
-            conditioning, pooled = self.meta_embed_prompt(prompt)
-            batch_size = len(images)
-            conditioning_batch = conditioning.expand(batch_size, -1, -1)
-            pooled_batch = pooled.expand(batch_size, -1)
-            kwargs["prompt_embeds"] = conditioning_batch
-            kwargs["pooled_prompt_embeds"] = pooled_batch
-        else:
-            kwargs["prompt"] = [prompt] * len(images)
-        return self.pipe(
+        kwargs = self.prompt_kwargs(prompt, len(images), use_compel, blend_prompts, blend_weights)
+        results = self.pipe(
             image=images,
             generator=self.generator,
             num_inference_steps=num_inference_steps,
             guidance_scale=0,
             strength=strength,
-            output_type="np",
+            output_type="np" if output == "float" else "pt",
             **kwargs
         ).images
+        return self.postprocess(results, output, count, crop)
+
+    def prompt_kwargs(self, prompt, batch_size, use_compel, blend_prompts, blend_weights):
+        kwargs = {}
+        if use_compel:
+            embedding = self.embed(prompt, blend_prompts, blend_weights)
+            if embedding is None:
+                # keep the previous prompt until the new one is ready
+                embedding = self.last_embedding
+            if embedding is None:
+                embedding = self.embed(prompt, blend_prompts, blend_weights, block=True)
+            self.last_embedding = embedding
+            conditioning, pooled = embedding
+            conditioning_batch = conditioning.expand(batch_size, -1, -1)
+            pooled_batch = pooled.expand(batch_size, -1)
+            kwargs["prompt_embeds"] = conditioning_batch
+            kwargs["pooled_prompt_embeds"] = pooled_batch
+        else:
+            kwargs["prompt"] = [prompt] * batch_size
+        return kwargs
+
+    # overlaps batches: while one batch is in the unet, the next one is
+    # uploaded and vae encoded and the previous one is decoded and
+    # downloaded, each on its own cuda stream. returns a future.
+    def run_async(
+        self,
+        images,
+        prompt,
+        num_inference_steps,
+        strength,
+        use_compel=False,
+        seed=None,
+        output="float",
+        blend_prompts=None,
+        blend_weights=None,
+    ):
+        futures = []
+        for batch, count, crop in self.split(images):
+            job = {
+                "images": batch,
+                "prompt": prompt,
+                "num_inference_steps": num_inference_steps,
+                "strength": min(max(1 / num_inference_steps, strength), 1),
+                "use_compel": use_compel,
+                "seed": seed,
+                "output": output,
+                "blend_prompts": blend_prompts,
+                "blend_weights": blend_weights,
+                "count": count,
+                "crop": crop,
+            }
+            futures.append(self.executor.submit(job))
+        if len(futures) == 1:
+            return futures[0]
+        return gather(futures, concat)
+
+    # grad mode is per thread, the pipe's own call disables it but the vae
+    # stages run on executor threads
+    @torch.no_grad()
+    def encode_stage(self, job):
+        images = self.prepare_images(job.pop("images"))
+        vae = self.pipe.vae
+        with self.vae_lock:
+            # AutoencoderTiny returns the latents directly
+            latents = vae.encode(images * 2 - 1).latents
+        job["latents"] = latents * vae.config.scaling_factor
+        job["kwargs"] = self.prompt_kwargs(
+            job["prompt"],
+            len(latents),
+            job["use_compel"],
+            job["blend_prompts"],
+            job["blend_weights"],
+        )
+        return job
+
+    def denoise_stage(self, job):
+        with self.lock:
+            if job["seed"] is not None:
+                self.generator = torch.manual_seed(job["seed"])
+            # latents are passed as the image, the pipeline skips its own encode
+            job["latents"] = self.pipe(
+                image=job["latents"],
+                generator=self.generator,
+                num_inference_steps=job["num_inference_steps"],
+                guidance_scale=0,
+                strength=job["strength"],
+                output_type="latent",
+                **job["kwargs"]
+            ).images
+        return job
+
+    @torch.no_grad()
+    def decode_stage(self, job):
+        vae = self.pipe.vae
+        with self.vae_lock:
+            images = vae.decode(job["latents"] / vae.config.scaling_factor, return_dict=False)[0]
+        if job["output"] == "float":
+            images = self.pipe.image_processor.postprocess(images, output_type="np")
+        else:
+            images = images / 2 + 0.5
+        return self.postprocess(images, job["output"], job["count"], job["crop"])
+
+    # uint8 batches are uploaded as they are and normalized on the gpu
+    def prepare_images(self, images):
+        if isinstance(images, np.ndarray) and images.dtype == np.uint8:
+            return normalize(images, self.device)
+        return images
+
+    # scale and cast on the gpu, so only uint8 crosses to the host. count
+    # and crop remove the bucket padding.
+    def postprocess(self, results, output, count=None, crop=None):
+        if output == "float":
+            if crop is not None:
+                results = np.ascontiguousarray(results[:count, : crop[0], : crop[1]])
+            return results
+        if crop is not None:
+            results = results[:count, :, : crop[0], : crop[1]]
+        results = quantize(results)
+        if output == "uint8_device":
+            return results
+        return to_host(results, self.output_buffers)
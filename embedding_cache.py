@@ -0,0 +1,141 @@
+import os
+import queue
+import hashlib
+import threading
+import concurrent.futures
+from collections import OrderedDict
+import torch
+
+
+def read_prompts(fn):
+    with open(fn) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# lru cache of prompt embeddings. missing prompts are embedded on a
+# background thread, so get(block=False) never waits for the text encoders,
+# and get(block=True) waits for the same request instead of embedding twice.
+# with a directory, embeddings are also stored on disk per model and prompt
+# so they survive restarts. with a remote EmbeddingClient, embeddings are
+# shared with the other workers through the server.
+class EmbeddingCache:
+    def __init__(self, embed, model, max_size=32, directory=None, device="cuda", remote=None):
+        self.embed = embed
+        self.model = model
+        self.remote = remote
+        self.max_size = max_size
+        self.directory = directory
+        self.device = device
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+        # prompt to future, while it is queued or embedded
+        self.pending = {}
+        self.requests = queue.Queue()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def key(self, prompt):
+        return hashlib.sha1(f"{self.model}\n{prompt}".encode()).hexdigest()
+
+    def path(self, prompt):
+        return os.path.join(self.directory, self.key(prompt) + ".pt")
+
+    def load(self, prompt):
+        if self.directory is None or not os.path.exists(self.path(prompt)):
+            return None
+        try:
+            return torch.load(self.path(prompt), map_location=self.device)
+        except Exception as e:
+            print("EmbeddingCache could not load", prompt, e)
+            return None
+
+    def save(self, prompt, embedding):
+        if self.directory is None:
+            return
+        # write to a temporary file first so other workers never see a partial file
+        tmp = self.path(prompt) + f".{os.getpid()}.tmp"
+        torch.save(tuple(e.cpu() for e in embedding), tmp)
+        os.replace(tmp, self.path(prompt))
+
+    def embed_now(self, prompt):
+        with torch.no_grad():
+            print("embedding prompt", prompt)
+            return self.embed(prompt)
+
+    def fetch(self, prompt):
+        def compute():
+            return [e.detach().to("cpu", torch.float16).numpy() for e in self.embed_now(prompt)]
+        arrays = self.remote.fetch(self.key(prompt), compute)
+        return tuple(torch.tensor(a, device=self.device) for a in arrays)
+
+    def compute(self, prompt):
+        embedding = self.load(prompt)
+        if embedding is None:
+            if self.remote is not None:
+                embedding = self.fetch(prompt)
+            else:
+                embedding = self.embed_now(prompt)
+            self.save(prompt, embedding)
+        self.put(prompt, embedding)
+        return embedding
+
+    def put(self, prompt, embedding):
+        with self.lock:
+            self.store[prompt] = embedding
+            self.store.move_to_end(prompt)
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    # returns the future of a missing prompt, or None if it is stored
+    def request(self, prompt):
+        with self.lock:
+            if prompt in self.store:
+                return None
+            future = self.pending.get(prompt)
+            if future is not None:
+                return future
+            future = concurrent.futures.Future()
+            self.pending[prompt] = future
+        self.requests.put(prompt)
+        return future
+
+    # returns None while a missing prompt is embedded in the background,
+    # unless block is set
+    def get(self, prompt, block=False):
+        with self.lock:
+            if prompt in self.store:
+                self.store.move_to_end(prompt)
+                return self.store[prompt]
+        future = self.request(prompt)
+        if future is None:
+            return self.get(prompt, block)
+        if block:
+            return future.result()
+        return None
+
+    def __contains__(self, prompt):
+        with self.lock:
+            return prompt in self.store
+
+    # embed a list of prompts before the show starts
+    def prewarm(self, prompts):
+        for prompt in prompts:
+            self.get(prompt, block=True)
+        print(f"EmbeddingCache prewarmed {len(prompts)} prompts")
+
+    def run(self):
+        while True:
+            prompt = self.requests.get()
+            try:
+                embedding = self.compute(prompt)
+            except Exception as e:
+                print("EmbeddingCache error", prompt, e)
+                with self.lock:
+                    future = self.pending.pop(prompt)
+                future.set_exception(e)
+                continue
+            with self.lock:
+                future = self.pending.pop(prompt)
+            future.set_result(embedding)
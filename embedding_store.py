@@ -0,0 +1,116 @@
+import time
+import threading
+import msgpack
+import numpy as np
+import zmq
+from threaded_worker import ThreadedWorker
+from fixed_size_dict import FixedSizeDict
+import socket_factory
+
+# prompt embeddings shared between workers through the server. the first
+# worker that asks for a missing key is elected to compute it and upload it,
+# the other workers wait for the upload instead of embedding it themselves.
+# embeddings travel as fp16 arrays.
+
+
+def pack_embedding(arrays):
+    return [
+        {"data": a.astype(np.float16).tobytes(), "shape": a.shape}
+        for a in arrays
+    ]
+
+
+def unpack_embedding(packed):
+    return [
+        np.frombuffer(e["data"], dtype=np.float16).reshape(e["shape"])
+        for e in packed
+    ]
+
+
+class EmbeddingStore(ThreadedWorker):
+    def __init__(self, settings, max_size=256):
+        super().__init__(has_input=False, has_output=False)
+        self.port = settings.embedding_port
+        self.store = FixedSizeDict(max_size)
+        self.elections = {}
+        # an elected worker that doesn't upload in time is replaced
+        self.election_timeout = 5
+
+    def setup(self):
+        self.sock = socket_factory.socket(zmq.ROUTER)
+        self.sock.bind(f"tcp://0.0.0.0:{self.port}")
+
+    def reply(self, identity, msg):
+        self.sock.send_multipart([identity, msgpack.packb(msg)])
+
+    def work(self):
+        if not self.sock.poll(100, zmq.POLLIN):
+            return
+        identity, msg = self.sock.recv_multipart()
+        unpacked = msgpack.unpackb(msg)
+        key = unpacked["key"]
+        if "embedding" in unpacked:
+            self.store[key] = unpacked["embedding"]
+            self.elections.pop(key, None)
+            return
+        if key in self.store:
+            self.reply(identity, {"key": key, "status": "ready", "embedding": self.store[key]})
+            return
+        now = time.time()
+        elected = self.elections.get(key)
+        if elected is not None and now - elected < self.election_timeout:
+            self.reply(identity, {"key": key, "status": "pending"})
+            return
+        self.elections[key] = now
+        self.reply(identity, {"key": key, "status": "compute"})
+
+    def cleanup(self):
+        self.sock.close()
+
+
+class EmbeddingClient:
+    def __init__(self, address, timeout=1, wait=5):
+        self.timeout = timeout
+        self.wait = wait
+        self.sock = socket_factory.socket(zmq.DEALER)
+        self.sock.connect(address)
+        # the embedding cache calls from its own thread and from run()
+        self.lock = threading.Lock()
+
+    # returns the status and the arrays if ready, or None if the store
+    # did not answer
+    def request(self, key):
+        self.sock.send(msgpack.packb({"key": key}))
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.sock.poll(int(remaining * 1000), zmq.POLLIN):
+                return None, None
+            unpacked = msgpack.unpackb(self.sock.recv())
+            if unpacked["key"] != key:
+                continue # late answer to an earlier request
+            if unpacked["status"] == "ready":
+                return "ready", unpack_embedding(unpacked["embedding"])
+            return unpacked["status"], None
+
+    # compute is called when this worker is elected, or when the store
+    # can't be reached
+    def fetch(self, key, compute):
+        with self.lock:
+            deadline = time.time() + self.wait
+            while time.time() < deadline:
+                status, arrays = self.request(key)
+                if status == "ready":
+                    return arrays
+                if status is None:
+                    break
+                if status == "compute":
+                    arrays = compute()
+                    self.sock.send(msgpack.packb({"key": key, "embedding": pack_embedding(arrays)}))
+                    return arrays
+                time.sleep(0.05)
+            print("EmbeddingClient store unavailable, embedding locally")
+            return compute()
+
+    def close(self):
+        self.sock.close()
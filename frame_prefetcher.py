@@ -0,0 +1,79 @@
+import time
+import threading
+from collections import OrderedDict
+from metrics import metrics
+
+# reads the frames after the current position on a background thread into
+# a bounded cache, so a slow disk doesn't show up as jitter at frame time.
+# seek() moves the read ahead, for example after a scrub. with a cache
+# size of at least the sequence length, the whole sequence stays cached
+# after the first loop.
+class FramePrefetcher:
+    def __init__(self, sequence, ahead=60, cache_size=300, name="FramePrefetcher"):
+        self.sequence = sequence
+        self.ahead = min(ahead, len(sequence))
+        self.cache_size = max(cache_size, self.ahead)
+        self.name = name
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.position = 0
+        self.wake = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, index, data):
+        with self.lock:
+            self.cache[index] = data
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def seek(self, index):
+        self.position = index
+        self.wake.set()
+
+    def get(self, index):
+        with self.lock:
+            data = self.cache.get(index)
+            if data is not None:
+                self.cache.move_to_end(index)
+        if data is None:
+            metrics.count(self.name, "prefetch_misses")
+            data = self.sequence[index]
+            self.put(index, data)
+        self.seek(index + 1)
+        return data
+
+    # waits until the first n frames after the position are cached
+    def wait(self, n, timeout=5):
+        deadline = time.time() + timeout
+        n = min(n, len(self.sequence))
+        position = self.position
+        while time.time() < deadline:
+            with self.lock:
+                missing = [i for i in range(n) if (position + i) % len(self.sequence) not in self.cache]
+            if not missing:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def run(self):
+        while self.running:
+            self.wake.wait(0.1)
+            self.wake.clear()
+            position = self.position
+            for i in range(self.ahead):
+                # a seek restarts the read ahead from the new position
+                if not self.running or self.position != position:
+                    break
+                index = (position + i) % len(self.sequence)
+                with self.lock:
+                    cached = index in self.cache
+                if not cached:
+                    self.put(index, self.sequence[index])
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
@@ -0,0 +1,234 @@
+import bisect
+import pickle
+import queue
+import threading
+
+# upper bounds in seconds, the last bucket catches everything above
+BUCKETS = [
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075,
+    0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1, 2, 5,
+]
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.sum / self.count
+
+    # linear interpolation inside the bucket that contains the percentile
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = p * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n > 0 and cumulative + n >= target:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - cumulative) / n
+            cumulative += n
+        return self.buckets[-1]
+
+    def state(self):
+        return self.counts.copy(), self.count, self.sum
+
+    def load(self, state):
+        counts, self.count, self.sum = state
+        self.counts = list(counts)
+
+
+def format_labels(stage, worker_id):
+    labels = f'stage="{stage}"'
+    if worker_id is not None:
+        labels += f',worker_id="{worker_id}"'
+    return labels
+
+
+# groups series of the same kind together, as prometheus expects
+def sort_key(item):
+    (stage, kind, worker_id), histogram = item
+    return kind, stage, str(worker_id)
+
+
+# the latest export of a stage process, in shared memory. nothing reads
+# it until the metrics are scraped, so each export replaces the previous
+# one instead of piling up, and the stage can exit at any time.
+class ExportSlot:
+    def __init__(self, context, size=1 << 20):
+        self.size = size
+        self.buffer = context.RawArray("B", size)
+        self.length = context.Value("q", 0)
+
+    def put(self, exported):
+        data = pickle.dumps(exported)
+        if len(data) > self.size:
+            return
+        with self.length.get_lock():
+            memoryview(self.buffer).cast("B")[: len(data)] = data
+            self.length.value = len(data)
+
+    # raises queue.Empty when there is nothing new
+    def get_nowait(self):
+        lock = self.length.get_lock()
+        # a stage killed during put() never releases the lock
+        if not lock.acquire(timeout=0.1):
+            raise queue.Empty
+        try:
+            n = self.length.value
+            if n == 0:
+                raise queue.Empty
+            data = bytes(memoryview(self.buffer).cast("B")[:n])
+            self.length.value = 0
+        finally:
+            lock.release()
+        return pickle.loads(data)
+
+
+# one registry per process. stages in process mode ship their histograms
+# to the parent through an ExportSlot that is attached with attach()
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.queues = []
+        self.sources = []
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.queues = []
+            self.sources = []
+
+    def histogram(self, stage, kind, worker_id=None):
+        key = (stage, kind, worker_id)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, stage, kind, value, worker_id=None):
+        self.histogram(stage, kind, worker_id).observe(value)
+
+    def count(self, stage, name, n=1, worker_id=None):
+        key = (stage, name, worker_id)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def register_queue(self, q):
+        with self.lock:
+            if q not in self.queues:
+                self.queues.append(q)
+
+    def attach(self, source):
+        with self.lock:
+            self.sources.append(source)
+
+    def export(self):
+        with self.lock:
+            items = list(self.histograms.items())
+            counters = self.counters.copy()
+        return [(key, histogram.state()) for key, histogram in items], counters
+
+    def merge(self, exported):
+        histograms, counters = exported
+        for key, state in histograms:
+            self.histogram(*key).load(state)
+        with self.lock:
+            self.counters.update(counters)
+
+    def collect(self):
+        for source in self.sources:
+            while True:
+                try:
+                    self.merge(source.get_nowait())
+                except queue.Empty:
+                    break
+
+    def snapshot(self):
+        self.collect()
+        with self.lock:
+            items = sorted(self.histograms.items(), key=sort_key)
+            counters = sorted(self.counters.items(), key=lambda e: str(e[0]))
+            queues = list(self.queues)
+        histograms = []
+        for (stage, kind, worker_id), histogram in items:
+            histograms.append(
+                {
+                    "stage": stage,
+                    "kind": kind,
+                    "worker_id": worker_id,
+                    "count": histogram.count,
+                    "mean": histogram.mean(),
+                    "p50": histogram.percentile(0.50),
+                    "p95": histogram.percentile(0.95),
+                    "p99": histogram.percentile(0.99),
+                }
+            )
+        return {
+            "histograms": histograms,
+            "counters": [
+                {"stage": stage, "name": name, "worker_id": worker_id, "value": value}
+                for (stage, name, worker_id), value in counters
+            ],
+            "queues": {q.name: q.stats() for q in queues},
+        }
+
+    def prometheus(self):
+        self.collect()
+        with self.lock:
+            items = sorted(self.histograms.items(), key=sort_key)
+            counters = sorted(self.counters.items(), key=lambda e: (e[0][1], str(e[0])))
+            queues = list(self.queues)
+        lines = []
+        declared = set()
+        for (stage, kind, worker_id), histogram in items:
+            name = f"i2i_{kind}_seconds"
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            labels = format_labels(stage, worker_id)
+            counts, count, total = histogram.state()
+            cumulative = 0
+            for le, n in zip(histogram.buckets + ["+Inf"], counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        for (stage, name, worker_id), value in counters:
+            name = f"i2i_{name}_total"
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            labels = format_labels(stage, worker_id)
+            lines.append(f"{name}{{{labels}}} {value}")
+        fields = [
+            ("size", "i2i_queue_size", "gauge"),
+            ("high_water", "i2i_queue_high_water", "gauge"),
+            ("drops", "i2i_queue_drops_total", "counter"),
+            ("blocked_time", "i2i_queue_blocked_seconds_total", "counter"),
+            ("wait_time", "i2i_queue_wait_seconds_total", "counter"),
+            ("count", "i2i_queue_items_total", "counter"),
+        ]
+        for field, name, kind in fields:
+            lines.append(f"# TYPE {name} {kind}")
+            for q in queues:
+                lines.append(f'{name}{{edge="{q.name}"}} {q.stats()[field]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -33,9 +33,8 @@ def main():
         input_fns = [os.path.join(input_directory, fn) for fn in batch]
         output_fns = [os.path.join(output_directory, fn) for fn in batch]
         images = [imread(fn) for fn in input_fns]
-        images = np.asarray(images, np.float32) / 255
-        output = diffusion.run(images, prompt, steps, strength, seed)
-        output = (output * 255).astype(np.uint8)
+        images = np.asarray(images)
+        output = diffusion.run(images, prompt, steps, strength, seed, output="uint8")
         for output_fn, image in zip(output_fns, output):
             imwrite(output_fn, image)
         
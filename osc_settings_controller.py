@@ -15,14 +15,29 @@ class OscSettingsController(ThreadedWorker):
         
     def update_blend(self):
         if self.blend == 0:
-            self.settings.prompt = self.prompt_0
+            self.set_prompt(self.prompt_0)
         elif self.blend == 1:
-            self.settings.prompt = self.prompt_1
+            self.set_prompt(self.prompt_1)
         else:
             a = self.prompt_0
             b = self.prompt_1
-            t = self.blend
-            self.settings.prompt = f'("{a}", "{b}").blend({1-t:.2f}, {t:.2f})'
+            t = float(self.blend)
+            self.set_blend([a, b], [1 - t, t])
+
+    def set_prompt(self, prompt):
+        self.settings.blend_prompts = []
+        self.settings.prompt = prompt
+
+    # prompt keeps the legacy blend string for workers that don't know blends
+    def set_blend(self, prompts, weights):
+        if not prompts or len(prompts) != len(weights):
+            print(self.name, f"ignoring blend of {len(prompts)} prompts with {len(weights)} weights")
+            return
+        self.settings.blend_weights = weights
+        self.settings.blend_prompts = prompts
+        blend = ", ".join(f'"{e}"' for e in prompts)
+        t = ", ".join(f"{e:.2f}" for e in weights)
+        self.settings.prompt = f"({blend}).blend({t})"
         
     def work(self):
         try:
@@ -32,7 +47,7 @@ class OscSettingsController(ThreadedWorker):
             if msg.address == "/prompt":
                 prompt = ' '.join(msg.params)
                 # print("OSC prompt:", prompt)
-                self.settings.prompt = prompt
+                self.set_prompt(prompt)
                 
             elif msg.address == "/blend":
                 a, b, t = msg.params
@@ -49,6 +64,11 @@ class OscSettingsController(ThreadedWorker):
             elif msg.address == "/blend_t":
                 self.blend = float(msg.params[0])
                 self.update_blend()
+            elif msg.address == "/blend_n":
+                # prompt, weight, prompt, weight, ...
+                prompts = [str(e) for e in msg.params[0::2]]
+                weights = [float(e) for e in msg.params[1::2]]
+                self.set_blend(prompts, weights)
                 
             elif msg.address == "/seed":
                 seed = msg.params[0]
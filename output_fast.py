@@ -2,26 +2,28 @@ import msgpack
 import zmq
 import time
 from threaded_worker import ThreadedWorker
+from metrics import metrics
+import socket_factory
 
 class OutputFast(ThreadedWorker):
     def __init__(self, port):
         super().__init__(has_output=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PUB)
-        self.sock.bind(f"tcp://0.0.0.0:{port}")
-        self.sock.setsockopt(zmq.SNDHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
+        # ShowStream in the same process reads over inproc
+        self.sock = socket_factory.socket(zmq.PUB, sndhwm=1)
+        socket_factory.bind(self.sock, port)
 
     def work(self, unpacked):
         timestamp = unpacked["frame_timestamp"]
         index = unpacked["index"]
         jpg = unpacked["jpg"]
-        packed = msgpack.packb([timestamp, index, jpg])
+        encoding = unpacked.get("encoding", "jpeg")
+        if encoding == "jpeg":
+            packed = msgpack.packb([timestamp, index, jpg])
+        else:
+            packed = msgpack.packb([timestamp, index, jpg, encoding, unpacked["shape"]])
         self.sock.send(packed)
-        # duration = time.time() - unpacked["frame_timestamp"]
-        # if index % 31 == 0:
-        #     print(f"full loop {int(duration*1000)}ms", flush=True)
+        frame_age = time.time() - timestamp
+        metrics.observe(self.name, "frame_age", frame_age, unpacked["worker_id"])
 
     def cleanup(self):
         self.sock.close()
-        self.context.term()
@@ -2,15 +2,15 @@ import time
 import msgpack
 import zmq
 from threaded_worker import ThreadedWorker
+from metrics import metrics
+import socket_factory
 
 class OutputSmooth(ThreadedWorker):
     def __init__(self, port, min_size=1, max_size=5, max_delay=200):
         super().__init__(has_output=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PUB)
-        self.sock.bind(f"tcp://0.0.0.0:{port}")
-        self.sock.setsockopt(zmq.SNDHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
+        # ShowStream in the same process reads over inproc
+        self.sock = socket_factory.socket(zmq.PUB, sndhwm=1)
+        socket_factory.bind(self.sock, port)
         self.max_delay = max_delay
         self.min_size = min_size
         self.max_size = max_size
@@ -31,9 +31,15 @@ class OutputSmooth(ThreadedWorker):
         #     f"outgoing: {index} #{worker_id} {int(1000*latency)}ms, {self.queue.qsize()}q {self.delay:.01f}ms"
         # )
 
-        packed = msgpack.packb([job_timestamp, index, jpg])
+        encoding = unpacked.get("encoding", "jpeg")
+        if encoding == "jpeg":
+            packed = msgpack.packb([job_timestamp, index, jpg])
+        else:
+            packed = msgpack.packb([job_timestamp, index, jpg, encoding, unpacked["shape"]])
 
         self.sock.send(packed)
+        frame_age = time.time() - unpacked["frame_timestamp"]
+        metrics.observe(self.name, "frame_age", frame_age, unpacked["worker_id"])
         
         # doing this with smaller amounts for smaller offsets
         # would help staibilize the framerate
@@ -53,4 +59,3 @@ class OutputSmooth(ThreadedWorker):
 
     def cleanup(self):
         self.sock.close()
-        self.context.term()
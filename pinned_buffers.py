@@ -0,0 +1,64 @@
+import sys
+import threading
+import torch
+
+# host buffers for copies between the gpu and the cpu. pinned memory lets
+# the copies run asynchronously but is slow to allocate, so a buffer is
+# handed out again once nothing outside the pool references it anymore.
+class PinnedBufferPool:
+    def __init__(self, max_buffers=8, pin=None):
+        self.max_buffers = max_buffers
+        # pinning fails in a process forked after cuda was initialized
+        self.pin = torch.cuda.is_available() if pin is None else pin
+        self.buffers = []
+        # buffers are handed out from several threads in the pipelined mode
+        self.lock = threading.Lock()
+
+    def free(self, i):
+        # only referenced by the pool entry and getrefcount
+        return sys.getrefcount(self.buffers[i][1]) <= 2
+
+    # returns a tensor and a numpy array sharing the same memory. the
+    # returned tuple is a new one, so the buffer counts as used as soon as
+    # the lock is released.
+    def get(self, shape, dtype=torch.uint8):
+        shape = tuple(shape)
+        with self.lock:
+            for i, (tensor, array) in enumerate(self.buffers):
+                if tuple(tensor.shape) == shape and tensor.dtype == dtype:
+                    del tensor, array
+                    if self.free(i):
+                        tensor, array = self.buffers[i]
+                        return tensor, array
+            if len(self.buffers) >= self.max_buffers:
+                # make room by dropping a buffer of another shape
+                for i in range(len(self.buffers)):
+                    if self.free(i):
+                        del self.buffers[i]
+                        break
+            tensor = torch.empty(shape, dtype=dtype, pin_memory=self.pin)
+            array = tensor.numpy()
+            self.buffers.append((tensor, array))
+            return tensor, array
+
+
+# uint8 NHWC host images to float NCHW in [0, 1] on the device, in one
+# transfer and one vectorized pass
+def normalize(images, device="cuda", dtype=torch.float16):
+    images = torch.from_numpy(images).to(device, non_blocking=True)
+    return images.permute(0, 3, 1, 2).to(dtype).div_(255)
+
+
+# float images in [0, 1] as NCHW, to uint8 NHWC on the same device
+def quantize(images):
+    images = images.clamp(0, 1).mul_(255).round_().to(torch.uint8)
+    return images.permute(0, 2, 3, 1).contiguous()
+
+
+# one non blocking copy into a reusable host buffer
+def to_host(images, pool):
+    tensor, array = pool.get(images.shape, images.dtype)
+    tensor.copy_(images, non_blocking=True)
+    if images.is_cuda:
+        torch.cuda.current_stream(images.device).synchronize()
+    return array
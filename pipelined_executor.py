@@ -0,0 +1,104 @@
+import queue
+import threading
+import concurrent.futures
+import torch
+
+# runs a chain of stages over a stream of items, one thread and one cuda
+# stream per stage, so different items overlap in different stages. an
+# event recorded after each stage makes the next stage's stream wait for
+# the work on the gpu without blocking the cpu. items finish in the order
+# they were submitted. on the cpu the streams and events are skipped,
+# which keeps the scheduling testable with a fake pipeline.
+
+
+def record_stream(value, stream):
+    # tensors handed to another stream must not be reused by the allocator
+    # of the stream that created them while the other stream still runs
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda:
+            value.record_stream(stream)
+    elif isinstance(value, dict):
+        for e in value.values():
+            record_stream(e, stream)
+    elif isinstance(value, (list, tuple)):
+        for e in value:
+            record_stream(e, stream)
+
+
+# one future for the results of several, combined in order
+def gather(futures, combine):
+    result = concurrent.futures.Future()
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        errors = [e.exception() for e in futures if e.exception() is not None]
+        if errors:
+            result.set_exception(errors[0])
+        else:
+            result.set_result(combine([e.result() for e in futures]))
+
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+class PipelinedExecutor:
+    def __init__(self, stages, device="cuda", depth=1):
+        self.stages = stages
+        self.cuda = torch.device(device).type == "cuda"
+        self.queues = [queue.Queue(maxsize=depth) for e in stages]
+        self.threads = []
+        for i in range(len(stages)):
+            thread = threading.Thread(target=self.run, args=(i,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # blocks while the first stage is full
+    def submit(self, item):
+        future = concurrent.futures.Future()
+        self.queues[0].put((future, item, None))
+        return future
+
+    def run(self, i):
+        stage = self.stages[i]
+        last = i == len(self.stages) - 1
+        stream = torch.cuda.Stream() if self.cuda else None
+        while True:
+            task = self.queues[i].get()
+            if task is None:
+                if not last:
+                    self.queues[i + 1].put(None)
+                return
+            future, item, event = task
+            if future.cancelled():
+                continue
+            try:
+                if stream is None:
+                    item = stage(item)
+                else:
+                    with torch.cuda.stream(stream):
+                        if event is not None:
+                            stream.wait_event(event)
+                            record_stream(item, stream)
+                        item = stage(item)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if last:
+                if stream is not None:
+                    event.synchronize()
+                future.set_result(item)
+            else:
+                self.queues[i + 1].put((future, item, event))
+
+    def close(self):
+        self.queues[0].put(None)
+        for thread in self.threads:
+            thread.join()
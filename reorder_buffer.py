@@ -0,0 +1,71 @@
+# reorder buffer addressed by index % capacity, with preallocated slots.
+# when two indices compete for a slot, the one closer to the index
+# we are waiting for is kept.
+class ReorderBuffer:
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self.indices = [-1] * capacity
+        self.messages = [None] * capacity
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return self.indices[index % self.capacity] == index
+
+    def discard(self, slot):
+        self.indices[slot] = -1
+        self.messages[slot] = None
+        self.count -= 1
+
+    # returns False if the message was dropped
+    def put(self, index, message, next_index=None):
+        slot = index % self.capacity
+        current = self.indices[slot]
+        if current == -1:
+            self.count += 1
+        elif current != index and next_index is not None:
+            if abs(index - next_index) >= abs(current - next_index):
+                return False
+        self.indices[slot] = index
+        self.messages[slot] = message
+        return True
+
+    # returns None if the index is not buffered. an older index left in
+    # the slot can't be emitted anymore and is dropped.
+    def pop(self, index):
+        slot = index % self.capacity
+        current = self.indices[slot]
+        if current != index:
+            if current != -1 and current < index:
+                self.discard(slot)
+            return None
+        message = self.messages[slot]
+        self.discard(slot)
+        return message
+
+    # smallest buffered index after the given one, or None.
+    # drops indices before the given one on the way.
+    def next_after(self, index):
+        later = None
+        for slot, e in enumerate(self.indices):
+            if e == -1:
+                continue
+            if e < index:
+                self.discard(slot)
+            elif e > index and (later is None or e < later):
+                later = e
+        return later
+
+    # drops everything before index, e.g. after the reader jumped ahead
+    def discard_before(self, index):
+        for slot, e in enumerate(self.indices):
+            if e != -1 and e < index:
+                self.discard(slot)
+
+    def clear(self):
+        for slot in range(self.capacity):
+            self.indices[slot] = -1
+            self.messages[slot] = None
+        self.count = 0
@@ -1,33 +1,86 @@
 from threaded_worker import ThreadedWorker
-import msgpack
 import time
 import zmq
-from fixed_size_dict import FixedSizeDict
+from wire_format import unpack_result
+from metrics import metrics
+from reorder_buffer import ReorderBuffer
+from zmq_receive import receive
+import socket_factory
 
 class ReorderingReceiver(ThreadedWorker):
-    def __init__(self, port):
-        super().__init__(has_input=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PULL)
+    def __init__(self, settings, mode="thread", worker_stats=None):
+        super().__init__(has_input=False, mode=mode)
+        self.port = settings.job_finish_port
+        self.settings = settings
+        self.worker_stats = worker_stats
+
+    def setup(self):
+        self.sock = socket_factory.socket(zmq.PULL, rcvhwm=1)
         self.sock.setsockopt(zmq.RCVTIMEO, 100)
-        self.sock.setsockopt(zmq.RCVHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
-        self.sock.bind(f"tcp://0.0.0.0:{port}")
+        self.sock.bind(f"tcp://0.0.0.0:{self.port}")
         self.reset_buffer()
         
     def reset_buffer(self):
-        self.msg_buffer = FixedSizeDict(100)
+        self.msg_buffer = ReorderBuffer(128)
         self.next_index = None
-        
+        self.gap_start = None
+
+    # how long to wait for a missing index before skipping it
+    def reorder_timeout(self):
+        if self.settings.reorder_timeout > 0:
+            return self.settings.reorder_timeout
+        workers = self.worker_stats.active() if self.worker_stats else []
+        if not workers:
+            return 0.5
+        # a frame from the slowest worker can arrive this long
+        # after a later frame from the fastest worker
+        fastest = min(self.worker_stats.round_trip(i) for i in workers)
+        slowest = max(
+            self.worker_stats.round_trip(i) + 3 * self.worker_stats.round_trip_std(i)
+            for i in workers
+        )
+        return max(slowest - fastest, 0.05)
+
+    def emit_ready(self):
+        advanced = False
+        unpacked = self.msg_buffer.pop(self.next_index)
+        while unpacked is not None:
+            self.output_queue.put(unpacked)
+            self.next_index += 1
+            advanced = True
+            unpacked = self.msg_buffer.pop(self.next_index)
+
+        # the timer runs while next_index is missing and later frames are
+        # buffered, from the moment next_index became the head
+        if len(self.msg_buffer) == 0:
+            self.gap_start = None
+        elif advanced or self.gap_start is None:
+            self.gap_start = time.time()
+
+    def skip_gap(self):
+        if self.gap_start is None:
+            return
+        if time.time() - self.gap_start < self.reorder_timeout():
+            return
+        later = self.msg_buffer.next_after(self.next_index)
+        if later is None:
+            return
+        skipped = later - self.next_index
+        metrics.count(self.name, "skipped_frames", skipped)
+        self.next_index += skipped
+        self.gap_start = None
+        self.emit_ready()
+
     def work(self):
-        try:
-            msg = self.sock.recv(flags=zmq.NOBLOCK, copy=False).bytes
-            # print(int(time.time()*1000)%1000, "receiving")
-        except zmq.Again:
+        # short timeout so gaps are still skipped on time
+        parts = receive(self.sock, timeout=0.01, multipart=True, copy=False)
+        if parts is None:
+            self.skip_gap()
             return
+        self.begin_work()
         
         receive_time = time.time()
-        unpacked = msgpack.unpackb(msg)
+        unpacked = unpack_result(parts)
         
         buffer_size = 30
         
@@ -40,38 +93,40 @@ class ReorderingReceiver(ThreadedWorker):
         elif self.next_index and index < self.next_index - buffer_size:
             print(self.name, f"resetting buffer due to {index} < {self.next_index} - {buffer_size}")
             self.reset_buffer()
-            
-        self.msg_buffer[index] = unpacked  # start by adding to buffer
 
-        if unpacked["index"] % 31 == 0: # close to 30, but prime (for logs)
-            round_trip = receive_time - unpacked["job_timestamp"]
-            worker_id = unpacked["worker_id"]
-            print(self.name, f"worker {worker_id} round trip: {int(1000*round_trip)}ms")
-
-        index = unpacked["index"]
         worker_id = unpacked["worker_id"]
-        jpg = unpacked["jpg"]
+        round_trip = receive_time - unpacked["job_timestamp"]
+        metrics.observe(self.name, "round_trip", round_trip, worker_id)
+        if self.worker_stats is not None:
+            self.worker_stats.observe(worker_id, round_trip, receive_time)
+        if "diffusion_time" in unpacked:
+            metrics.observe(self.name, "diffusion", unpacked["diffusion_time"], worker_id)
 
         if self.next_index is None:
             # if next_index is None, let's start with this one
             self.next_index = index
 
-        diff = abs(index - self.next_index)
-        if diff > 10:
-            # if we got a big jump, let's just jump to it
-            # this also works for resetting to 0
+        diff = index - self.next_index
+        if diff >= self.msg_buffer.capacity:
+            # a discontinuity the buffer can't hold, jump to it. smaller
+            # gaps are left to skip_gap and the reorder timeout.
+            metrics.count(self.name, "skipped_frames", diff)
             self.next_index = index
+            self.msg_buffer.discard_before(index)
+        elif diff < 0:
+            # already skipped or emitted, too late to show
+            metrics.count(self.name, "late_frames", 1, worker_id)
+            return
+
+        if not self.msg_buffer.put(index, unpacked, self.next_index):
+            metrics.count(self.name, "evicted_frames", 1, worker_id)
 
         # packed = msgpack.packb([timestamp, index, jpg])
         # publisher.send(packed) # echo mode
 
         # ordered mode
-        while self.next_index in self.msg_buffer:
-            unpacked = self.msg_buffer[self.next_index]
-            self.output_queue.put(unpacked)
-            del self.msg_buffer[self.next_index]
-            self.next_index += 1
+        self.emit_ready()
+        self.skip_gap()
         
     def cleanup(self):
-        self.sock.close()
-        self.context.term()
\ No newline at end of file
+        self.sock.close()
\ No newline at end of file
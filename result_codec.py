@@ -0,0 +1,88 @@
+import threading
+import numpy as np
+from turbojpeg import TurboJPEG, TJPF_RGB
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# jpeg_adaptive is jpeg with the quality lowered as the encoder falls behind
+ENCODINGS = ["jpeg", "jpeg_adaptive", "lz4", "zstd"]
+
+# optional packages needed for each encoding
+PACKAGES = {"lz4": "lz4", "zstd": "zstandard"}
+
+
+def supported(encoding):
+    if encoding == "lz4":
+        return lz4 is not None
+    if encoding == "zstd":
+        return zstandard is not None
+    return encoding in ENCODINGS
+
+
+# raises if results in this encoding can't be decoded here
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unknown result encoding {encoding}, use one of {', '.join(ENCODINGS)}")
+    if not supported(encoding):
+        raise ValueError(f"result encoding {encoding} needs the {PACKAGES[encoding]} package")
+
+
+# safe to share between threads, turbojpeg and lz4 release the GIL
+class ResultEncoder:
+    def __init__(self, min_quality=50, quality_step=10):
+        self.jpeg = TurboJPEG()
+        self.min_quality = min_quality
+        self.quality_step = quality_step
+        self.local = threading.local()
+
+    @property
+    def zstd(self):
+        # zstd compressors can't be used from several threads at once
+        if not hasattr(self.local, "zstd"):
+            self.local.zstd = zstandard.ZstdCompressor(level=1)
+        return self.local.zstd
+
+    # returns the payload and the header fields needed to decode it
+    def encode(self, img_u8, encoding="jpeg", quality=85, backlog=0):
+        if not supported(encoding):
+            encoding = "jpeg"
+        if encoding == "jpeg_adaptive":
+            quality -= backlog * self.quality_step
+            quality = max(quality, self.min_quality)
+            encoding = "jpeg"
+        if encoding == "jpeg":
+            jpg = self.jpeg.encode(img_u8, quality=quality, pixel_format=TJPF_RGB)
+            return jpg, {"encoding": "jpeg", "quality": quality}
+        raw = np.ascontiguousarray(img_u8)
+        if encoding == "lz4":
+            payload = lz4.frame.compress(raw)
+        else:
+            payload = self.zstd.compress(raw)
+        return payload, {"encoding": encoding, "shape": raw.shape}
+
+
+class ResultDecoder:
+    def __init__(self):
+        self.jpeg = TurboJPEG()
+        if zstandard is not None:
+            self.zstd = zstandard.ZstdDecompressor()
+
+    def decode(self, payload, encoding="jpeg", shape=None):
+        if encoding == "jpeg":
+            return self.jpeg.decode(payload, pixel_format=TJPF_RGB)
+        check_encoding(encoding)
+        if encoding == "lz4":
+            raw = lz4.frame.decompress(payload, return_bytearray=True)
+        elif encoding == "zstd":
+            raw = self.zstd.decompress(payload)
+        else:
+            raise ValueError(f"can't decode {encoding} results")
+        return np.frombuffer(raw, dtype=np.uint8).reshape(shape)
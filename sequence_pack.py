@@ -0,0 +1,99 @@
+import os
+import mmap
+import struct
+import argparse
+import numpy as np
+from natsort import natsorted
+
+# a packed sequence is one file with all jpgs of a sequence back to back,
+# followed by an index of offset, length and timestamp per frame, and a
+# footer pointing at the index. it is read through mmap.
+#
+#   magic | jpg 0 | jpg 1 | ... | index | index offset, count, magic
+
+MAGIC = b"I2ISEQ01"
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("timestamp", "<f8")])
+FOOTER = struct.Struct("<QI8s")
+
+
+def pack_sequence(directory, fn, fps=30):
+    fns = natsorted(os.listdir(directory))
+    index = np.zeros(len(fns), dtype=INDEX_DTYPE)
+    with open(fn + ".tmp", "wb") as f:
+        f.write(MAGIC)
+        for i, name in enumerate(fns):
+            with open(os.path.join(directory, name), "rb") as frame:
+                data = frame.read()
+            index[i] = (f.tell(), len(data), i / fps)
+            f.write(data)
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        f.write(FOOTER.pack(index_offset, len(fns), MAGIC))
+    os.replace(fn + ".tmp", fn)
+    return len(fns)
+
+
+class PackedSequence:
+    def __init__(self, fn):
+        self.fn = fn
+        self.file = open(fn, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, count, magic = FOOTER.unpack_from(self.mmap, len(self.mmap) - FOOTER.size)
+        if magic != MAGIC or self.mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{fn} is not a packed sequence")
+        self.index = np.frombuffer(self.mmap, INDEX_DTYPE, count, index_offset)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        offset, length, _ = self.index[i]
+        return self.mmap[offset : offset + length]
+
+    def timestamp(self, i):
+        return float(self.index[i]["timestamp"])
+
+    def close(self):
+        # the index is a view of the mmap
+        self.index = None
+        self.mmap.close()
+        self.file.close()
+
+
+class DirectorySequence:
+    def __init__(self, directory, fps=30):
+        self.directory = directory
+        self.fps = fps
+        self.fns = natsorted(os.listdir(directory))
+
+    def __len__(self):
+        return len(self.fns)
+
+    def __getitem__(self, i):
+        with open(os.path.join(self.directory, self.fns[i]), "rb") as f:
+            return f.read()
+
+    def timestamp(self, i):
+        return i / self.fps
+
+    def close(self):
+        pass
+
+
+# uses the packed file next to the directory when there is one
+def open_sequence(directory, fps=30):
+    fn = directory.rstrip("/") + ".seq"
+    if os.path.isfile(fn):
+        return PackedSequence(fn)
+    return DirectorySequence(directory, fps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a directory of jpgs into a sequence file")
+    parser.add_argument("directory", help="e.g. data/frames")
+    parser.add_argument("--output", help="defaults to the directory name with .seq")
+    parser.add_argument("--fps", type=float, default=30)
+    args = parser.parse_args()
+    output = args.output or args.directory.rstrip("/") + ".seq"
+    count = pack_sequence(args.directory, output, args.fps)
+    print(f"packed {count} frames into {output}")
@@ -1,4 +1,5 @@
 import os
+import time
 import psutil
 
 from settings import Settings
@@ -14,32 +15,52 @@ from output_smooth import OutputSmooth
 from output_fast import OutputFast
 from reordering_receiver import ReorderingReceiver
 from show_stream import ShowStream
+from worker_stats import WorkerStats
+from embedding_store import EmbeddingStore
+import socket_factory
+from result_codec import check_encoding
 
 # load up settings
 settings = Settings()
 
+# the display decodes the results, fail now rather than on the first frame
+check_encoding(settings.result_encoding)
+
+# one zmq context and the socket options for all stages
+socket_factory.configure(settings)
+
 # create endpoint
 settings_api = SettingsAPI(settings)
 
+# round trip and throughput per worker, shared by both ends
+worker_stats = WorkerStats()
+
 # create sending end
 if settings.mode == "video":
     video = ThreadedSequence(settings)
     controller = OscVideoController(video, settings)
 elif settings.mode == "camera":
-    video = ThreadedCamera()
+    video = ThreadedCamera(settings)
     controller = OscSettingsController(settings)
 elif settings.mode == "zmq":
     video = ThreadedZmqVideo(settings)
     controller = OscSettingsController(settings)
-batcher = BatchingWorker(settings).feed(video)
-sender = ZmqSender(settings).feed(batcher)
+queue_args = (settings.queue_size, settings.queue_policy)
+batcher = BatchingWorker(settings, worker_stats).feed(video, *queue_args)
+sender = ZmqSender(settings, worker_stats).feed(batcher, *queue_args)
 
 # create receiving end
-reordering_receiver = ReorderingReceiver(settings.job_finish_port)
+stage_mode = "process" if settings.process_stages else "thread"
+reordering_receiver = ReorderingReceiver(settings, stage_mode, worker_stats)
 if settings.output_fast:
-    output = OutputFast(settings.output_port).feed(reordering_receiver)
+    output = OutputFast(settings.output_port).feed(reordering_receiver, *queue_args)
 else:
-    output = OutputSmooth(settings.output_port).feed(reordering_receiver)
+    output = OutputSmooth(settings.output_port).feed(reordering_receiver, *queue_args)
+
+# shares prompt embeddings between workers
+embedding_store = None
+if settings.embedding_broadcast:
+    embedding_store = EmbeddingStore(settings)
 
 # create display end
 show_stream = ShowStream(settings.output_port, settings)
@@ -51,6 +72,8 @@ show_stream.start()
 
 # start receiving end
 settings_api.start()
+if embedding_store is not None:
+    embedding_store.start()
 reordering_receiver.start()
 output.start()
 
@@ -70,6 +93,7 @@ try:
         memory_usage_gb = memory_usage_bytes / (1024**3)
         if memory_usage_gb > 10:
             print(f"memory usage: {memory_usage_gb:.2f}GB")
+        time.sleep(1)
 except KeyboardInterrupt:
     pass
 
@@ -87,6 +111,8 @@ reordering_receiver.close()
 # close sending end
 controller.close()
 settings_api.close()
+if embedding_store is not None:
+    embedding_store.close()
 sender.close()
 batcher.close()
 video.close()
@@ -1,34 +1,87 @@
+from typing import List
 from pydantic.v1 import BaseSettings, Field
 
 class Settings(BaseSettings):
     # config, cannot be changed
     mode: str = Field(default="video")
+    # decode, crop (lossless mjpeg crop) or passthrough (mjpeg as is)
+    camera_mode: str = Field(default="decode")
+    # directory of jpgs to use as a fake camera
+    camera_source: str = Field(default=None)
     worker_id: int = Field(default=0)
     
     output_fast: bool = Field(default=True)
+    zmq_video_host: str = Field(default='10.0.0.24')
     zmq_video_port: int = Field(default=5554)
+    # keep only the latest message on the video input and the display
+    zmq_conflate: bool = Field(default=False)
+    # one context per process, see socket_factory.py
+    zmq_io_threads: int = Field(default=2)
+    zmq_linger: int = Field(default=0)
+    zmq_tcp_keepalive: bool = Field(default=True)
+    # kernel socket buffer sizes in bytes, 0 keeps the os default
+    zmq_sndbuf: int = Field(default=0)
+    zmq_rcvbuf: int = Field(default=0)
+    # ShowStream reads the output over inproc instead of tcp loopback
+    zmq_inproc: bool = Field(default=True)
     job_start_port: int = Field(default=5555)
     settings_port: int = Field(default=5556)
     job_finish_port: int = Field(default=5557)
     output_port: int = Field(default=5558)
+    embedding_port: int = Field(default=5559)
     osc_port: int = Field(default=8000)
     primary_hostname: str = Field(default='localhost')
+    wire_format: int = Field(default=2)
+    dispatch: str = Field(default="push")
+    worker_credits: int = Field(default=2)
+    worker_timeout: float = Field(default=3)
+    dispatch_timeout: float = Field(default=1)
+    straggler_factor: float = Field(default=1.5)
+    reorder_timeout: float = Field(default=0)
+    result_encoding: str = Field(default="jpeg")
+    jpeg_quality: int = Field(default=85)
+    jpeg_min_quality: int = Field(default=50)
+    encoder_threads: int = Field(default=4)
     
     translation: bool = Field(default=False)
     safety: bool = Field(default=False)
     local_files_only: bool = Field(default=False)
     warmup: str = Field(default=None)
+    # batch shapes like 4x576x1024,2x576x1024 to warm up and pad batches to
+    shape_buckets: str = Field(default=None)
+    pipelined: bool = Field(default=False)
+    # "passthrough" answers jobs with the input until the model is warm,
+    # "refuse" leaves them to the other workers
+    startup_policy: str = Field(default="passthrough")
+    compile_cache_dir: str = Field(default=None)
+    embedding_cache_size: int = Field(default=32)
+    embedding_cache_dir: str = Field(default=None)
+    prewarm_prompts: str = Field(default=None)
+    embedding_broadcast: bool = Field(default=False)
     threaded: bool = Field(default=False)
+    process_stages: bool = Field(default=False)
+    queue_size: int = Field(default=8)
+    queue_policy: str = Field(default="drop_oldest")
     
     # parameters for inference
     prompt: str = Field(default='A psychedelic landscape.')
+    # when set, the prompts are blended with these weights instead of using prompt
+    blend_prompts: List[str] = Field(default=[])
+    blend_weights: List[float] = Field(default=[])
     num_inference_steps: int = Field(default=2)
     fixed_seed: bool = Field(default=True)
     seed: int = Field(default=0)
     batch_size: int = Field(default=4)
+    batch_mode: str = Field(default="fixed")
+    batch_min: int = Field(default=1)
+    batch_max: int = Field(default=8)
+    batch_max_wait: float = Field(default=0)
     strength: float = Field(default=0.7)
     passthrough: bool = Field(default=False)
     compel: bool = Field(default=True)
+    # reuse the last output while the input luma changes less than the threshold
+    static_reuse: bool = Field(default=False)
+    static_threshold: float = Field(default=0.01)
     
     # can be changed dynamically
     opacity: float = Field(default=1.0)
@@ -37,6 +90,11 @@ class Settings(BaseSettings):
     pad: bool = Field(default=False)
     fps: int = Field(default=30)
     directory: str = Field(default='data/frames')
+    # "drop" skips frames to stay on time when playback falls behind, "slow" plays them late
+    catchup: str = Field(default="drop")
+    prefetch_frames: int = Field(default=60)
+    prefetch_cache: int = Field(default=300)
+    prefetch_all: bool = Field(default=False)
     
     class Config:
         env_file = ".env"
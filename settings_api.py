@@ -2,11 +2,13 @@ import threading
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import time
 import json
 
 from safety_checker import SafetyChecker
 from translate import Translate
+from metrics import metrics
 
 
 class SettingsAPI:
@@ -54,6 +56,7 @@ class SettingsAPI:
                     print(f"Ignoring prompt ({safety}):", prompt)
                     return {"safety": "unsafe"}
             
+            self.settings.blend_prompts = []
             self.settings.prompt = prompt
             print("Updated prompt:", prompt)
             return {"safety": "safe"}
@@ -100,6 +103,14 @@ class SettingsAPI:
             print("Updated batch_size:", self.settings.batch_size)
             return {"status": "updated"}
 
+        @app.get("/batch_mode/{value}")
+        async def batch_mode(value: str):
+            if value not in ["fixed", "adaptive"]:
+                return {"status": "invalid"}
+            self.settings.batch_mode = value
+            print("Updated batch_mode:", self.settings.batch_mode)
+            return {"status": "updated"}
+
         @app.get("/seed/{value}")
         async def seed(value: int):
             self.settings.seed = value
@@ -125,6 +136,28 @@ class SettingsAPI:
             print("Updated opacity:", self.settings.opacity)
             return {"status": "updated"}
 
+        @app.get("/static_reuse/{status}")
+        async def static_reuse(status: bool):
+            self.settings.static_reuse = status
+            print("Updated static_reuse:", self.settings.static_reuse)
+            return {"status": "updated"}
+
+        @app.get("/static_threshold/{value}")
+        async def static_threshold(value: float):
+            self.settings.static_threshold = max(value, 0)
+            print("Updated static_threshold:", self.settings.static_threshold)
+            return {"status": "updated"}
+
+        @app.get("/metrics")
+        async def prometheus_metrics():
+            return PlainTextResponse(
+                metrics.prometheus(), media_type="text/plain; version=0.0.4"
+            )
+
+        @app.get("/metrics/json")
+        async def json_metrics():
+            return metrics.snapshot()
+
         config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
         self.server = uvicorn.Server(config=config)
         try:
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+# "4x576x1024,2x576x1024" to [(4, 576, 1024), (2, 576, 1024)]
+def parse_buckets(text):
+    return [tuple(int(e) for e in bucket.split("x")) for bucket in text.split(",")]
+
+
+def volume(shape):
+    return shape[0] * shape[1] * shape[2]
+
+
+# the batch shapes the pipeline has been warmed up for. incoming batches
+# are padded up to the smallest warm bucket that holds them, or center
+# cropped to the warm bucket that keeps the most pixels, so the compiled
+# pipeline never sees a shape it hasn't captured.
+class ShapeBuckets:
+    def __init__(self, shapes):
+        self.shapes = sorted(shapes, key=volume)
+        self.warm = set()
+
+    # returns None until a bucket is warm
+    def choose(self, n, height, width):
+        warm = [e for e in self.shapes if e in self.warm]
+        if not warm:
+            return None
+        fits = [e for e in warm if e[0] >= n and e[1] >= height and e[2] >= width]
+        if fits:
+            return fits[0]
+        return max(warm, key=lambda e: (min(e[1], height) * min(e[2], width), min(e[0], n)))
+
+
+# pad or center crop a uint8 NHWC batch to the bucket. frames are padded by
+# repeating the edge pixels, and the batch by repeating the last frame.
+def fit(images, shape):
+    n, height, width = shape
+    top = max(images.shape[1] - height, 0) // 2
+    left = max(images.shape[2] - width, 0) // 2
+    images = images[:n, top : top + height, left : left + width]
+    pad = [
+        (0, n - images.shape[0]),
+        (0, height - images.shape[1]),
+        (0, width - images.shape[2]),
+        (0, 0),
+    ]
+    if any(e[1] > 0 for e in pad):
+        images = np.pad(images, pad, mode="edge")
+    return images
@@ -0,0 +1,174 @@
+import io
+import os
+import atexit
+import time
+import pickle
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+from bounded_queue import POLICIES
+
+
+class SlotPickler(pickle.Pickler):
+    # memoryviews (e.g. zmq frame buffers) are not picklable by default,
+    # send them out-of-band so they land directly in the shared memory slot
+    def reducer_override(self, obj):
+        if isinstance(obj, memoryview):
+            return memoryview, (pickle.PickleBuffer(obj),)
+        return NotImplemented
+
+
+def dumps(obj, out_of_band=True):
+    buffers = []
+    f = io.BytesIO()
+    buffer_callback = buffers.append if out_of_band else None
+    SlotPickler(f, protocol=5, buffer_callback=buffer_callback).dump(obj)
+    return f.getbuffer(), [buffer.raw() for buffer in buffers]
+
+
+# multiprocessing queue that moves payloads through a ring of fixed-size
+# shared memory slots. only the slot number and buffer lengths go through the
+# pipe, payloads that do not fit in a slot fall back to a regular pickle.
+# the number of slots is the maximum depth, the policy decides what happens
+# when all slots are in use. counters live in shared memory too.
+class SharedMemoryQueue:
+    def __init__(self, maxsize=0, policy="block", slot_size=64 * 1024 * 1024):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy}")
+        self.slots = maxsize if maxsize > 0 else 4
+        self.maxsize = self.slots
+        self.policy = policy
+        self.name = None
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * slot_size)
+        self.owner_pid = os.getpid()
+        # either end may still be using the queue while the other closes,
+        # so the memory is released when the owning process exits
+        atexit.register(self.unlink)
+        self.free = multiprocessing.Queue()
+        for slot in range(self.slots):
+            self.free.put(slot)
+        self.queue = multiprocessing.Queue()
+        self.drops = multiprocessing.Value("q", 0)
+        self.high_water = multiprocessing.Value("q", 0)
+        self.blocked_time = multiprocessing.Value("d", 0)
+        self.wait_time = multiprocessing.Value("d", 0)
+        self.count = multiprocessing.Value("q", 0)
+        self.last_wait = 0
+
+    def acquire_slot(self, block, timeout):
+        if self.policy == "block":
+            start_time = time.time()
+            try:
+                return self.free.get(block, timeout)
+            except queue.Empty:
+                raise queue.Full
+            finally:
+                with self.blocked_time.get_lock():
+                    self.blocked_time.value += time.time() - start_time
+        # the drop policies never raise. a multiprocessing queue can look
+        # empty for a moment after a put, so both queues get a short wait.
+        while True:
+            try:
+                return self.free.get(timeout=0.005)
+            except queue.Empty:
+                pass
+            if self.policy == "drop_newest":
+                with self.drops.get_lock():
+                    self.drops.value += 1
+                return None
+            # drop_oldest: take over the slot of the oldest item in the queue
+            try:
+                slot, payload, put_time = self.queue.get(timeout=0.005)
+            except queue.Empty:
+                # a reader took it, its slot is on the way back to free
+                continue
+            with self.drops.get_lock():
+                self.drops.value += 1
+            if slot is not None:
+                return slot
+
+    def put(self, obj, block=True, timeout=None):
+        header, buffers = dumps(obj)
+        lengths = [len(header)] + [buffer.nbytes for buffer in buffers]
+        if sum(lengths) > self.slot_size:
+            header, _ = dumps(obj, out_of_band=False)
+            self.queue.put((None, bytes(header), time.time()), block, timeout)
+            return
+
+        slot = self.acquire_slot(block, timeout)
+        if slot is None:
+            return
+
+        offset = slot * self.slot_size
+        for buffer in [header] + buffers:
+            n = buffer.nbytes
+            self.shm.buf[offset : offset + n] = buffer
+            offset += n
+        self.queue.put((slot, lengths, time.time()))
+        size = self.queue.qsize()
+        with self.high_water.get_lock():
+            self.high_water.value = max(self.high_water.value, size)
+
+    def get(self, block=True, timeout=None):
+        slot, payload, put_time = self.queue.get(block, timeout)
+        self.last_wait = time.time() - put_time
+        with self.wait_time.get_lock():
+            self.wait_time.value += self.last_wait
+        with self.count.get_lock():
+            self.count.value += 1
+        if slot is None:
+            return pickle.loads(payload)
+
+        try:
+            offset = slot * self.slot_size
+            header_length = payload[0]
+            header = self.shm.buf[offset : offset + header_length]
+            offset += header_length
+            buffers = []
+            for n in payload[1:]:
+                buffers.append(bytearray(self.shm.buf[offset : offset + n]))
+                offset += n
+            obj = pickle.loads(header, buffers=buffers)
+            header.release()
+        finally:
+            self.free.put(slot)
+        return obj
+
+    def put_nowait(self, obj):
+        return self.put(obj, block=False)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def clear(self):
+        while True:
+            try:
+                self.get_nowait()
+            except queue.Empty:
+                return
+
+    def stats(self):
+        return {
+            "size": self.qsize(),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "drops": self.drops.value,
+            "high_water": self.high_water.value,
+            "blocked_time": self.blocked_time.value,
+            "wait_time": self.wait_time.value,
+            "count": self.count.value,
+        }
+
+    def unlink(self):
+        if os.getpid() != self.owner_pid or self.shm.buf is None:
+            return
+        atexit.unregister(self.unlink)
+        self.shm.close()
+        self.shm.unlink()
@@ -1,10 +1,12 @@
 import cv2
 import numpy as np
-from turbojpeg import TurboJPEG, TJPF_RGB
 import zmq
 import msgpack
 import time
 from threaded_worker import ThreadedWorker
+from result_codec import ResultDecoder
+from zmq_receive import receive, conflate
+import socket_factory
 
 class ShowStream(ThreadedWorker):
     def __init__(self, port, settings):
@@ -14,16 +16,14 @@ class ShowStream(ThreadedWorker):
         self.settings = settings
         
     def setup(self):
-        self.jpeg = TurboJPEG()
+        self.decoder = ResultDecoder()
         
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.SUB)
+        self.sock = socket_factory.socket(zmq.SUB, rcvhwm=1)
         self.sock.setsockopt(zmq.RCVTIMEO, 100)
-        self.sock.setsockopt(zmq.RCVHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
-        address = f"tcp://localhost:{self.port}"
-        print(f"Connecting to {address}")
-        self.sock.connect(address)
+        if self.settings.zmq_conflate:
+            conflate(self.sock)
+        address = socket_factory.connect(self.sock, "localhost", self.port, local=True)
+        print(f"Connected to {address}")
         self.sock.setsockopt(zmq.SUBSCRIBE, b"")
         
         self.window_name = f"Port {self.port}"
@@ -32,8 +32,8 @@ class ShowStream(ThreadedWorker):
             cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
 
     def show_msg(self, msg):
-        timestamp, index, jpg = msgpack.unpackb(msg)
-        img = self.jpeg.decode(jpg, pixel_format=TJPF_RGB)
+        timestamp, index, payload, *encoding = msgpack.unpackb(msg)
+        img = self.decoder.decode(payload, *encoding)
         input_h, input_w = img.shape[:2]
 
         if self.settings.mirror:
@@ -45,6 +45,8 @@ class ShowStream(ThreadedWorker):
             img = canvas
         
         if self.settings.debug:
+            if not img.flags.writeable:
+                img = img.copy()
             latency = time.time() - timestamp
             text = f"{input_w}x{input_h} @ {int(1000*latency)} ms"
             cv2.putText(
@@ -61,11 +63,10 @@ class ShowStream(ThreadedWorker):
         cv2.imshow(self.window_name, img[:, :, ::-1])
 
     def work(self):
-        try:
-            msg = self.sock.recv(flags=zmq.NOBLOCK, copy=False).bytes
+        msg = receive(self.sock, timeout=0.01)
+        if msg is not None:
+            self.begin_work()
             self.show_msg(msg)
-        except zmq.Again:
-            pass
 
         key = cv2.waitKey(1)
         # toggle fullscreen when user presses 'f' key
@@ -82,5 +83,4 @@ class ShowStream(ThreadedWorker):
                 
     def cleanup(self):
         self.sock.close()
-        self.context.term()
         cv2.destroyAllWindows()
\ No newline at end of file
@@ -4,6 +4,7 @@ import zmq
 import msgpack
 import time
 from threaded_worker import ThreadedWorker
+import socket_factory
 import torch
 import torch.nn.functional as F
 
@@ -45,8 +46,7 @@ def uyvy_to_rgb_full(uyvy_image):
 class ShowStream(ThreadedWorker):
     def __init__(self):
         super().__init__(has_input=False, has_output=False)
-        self.context = zmq.Context()
-        self.img_subscriber = self.context.socket(zmq.SUB)
+        self.img_subscriber = socket_factory.socket(zmq.SUB)
         address = f"ipc:///tmp/zmq"
         print(f"Connecting to {address}")
         self.img_subscriber.connect(address)
@@ -81,7 +81,6 @@ class ShowStream(ThreadedWorker):
                 
     def cleanup(self):
         self.img_subscriber.close()
-        self.context.term()
         cv2.destroyAllWindows()
         
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+import zmq
+
+# one zmq context per process shared by all stages, and the socket options
+# from Settings in one place. apps call configure(settings) at startup,
+# stage processes inherit the options when they are forked.
+options = {
+    "io_threads": 1,
+    "linger": 0,
+    "tcp_keepalive": True,
+    "sndbuf": 0,
+    "rcvbuf": 0,
+    "inproc": True,
+}
+
+
+def configure(settings):
+    options["io_threads"] = settings.zmq_io_threads
+    options["linger"] = settings.zmq_linger
+    options["tcp_keepalive"] = settings.zmq_tcp_keepalive
+    options["sndbuf"] = settings.zmq_sndbuf
+    options["rcvbuf"] = settings.zmq_rcvbuf
+    options["inproc"] = settings.zmq_inproc
+
+
+def context():
+    # Context.instance creates a new context after a fork
+    return zmq.Context.instance(options["io_threads"])
+
+
+def socket(kind, sndhwm=None, rcvhwm=None):
+    sock = context().socket(kind)
+    sock.setsockopt(zmq.LINGER, options["linger"])
+    if options["tcp_keepalive"]:
+        # notice dead peers across the network instead of waiting forever
+        sock.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        sock.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 10)
+        sock.setsockopt(zmq.TCP_KEEPALIVE_INTVL, 5)
+    if options["sndbuf"] > 0:
+        sock.setsockopt(zmq.SNDBUF, options["sndbuf"])
+    if options["rcvbuf"] > 0:
+        sock.setsockopt(zmq.RCVBUF, options["rcvbuf"])
+    if sndhwm is not None:
+        sock.setsockopt(zmq.SNDHWM, sndhwm)
+    if rcvhwm is not None:
+        sock.setsockopt(zmq.RCVHWM, rcvhwm)
+    return sock
+
+
+def inproc_address(port):
+    return f"inproc://port-{port}"
+
+
+# binds on tcp, and on inproc for stages in the same process
+def bind(sock, port):
+    sock.bind(f"tcp://0.0.0.0:{port}")
+    if options["inproc"]:
+        sock.bind(inproc_address(port))
+
+
+# local stages in the same process skip the tcp loopback
+def connect(sock, hostname, port, local=False):
+    if local and options["inproc"]:
+        address = inproc_address(port)
+    else:
+        address = f"tcp://{hostname}:{port}"
+    sock.connect(address)
+    return address
@@ -10,9 +10,11 @@ import torch.nn.functional as F
 from turbojpeg import TurboJPEG, TJPF_RGB
 from threaded_worker import ThreadedWorker
 from diffusion_processor import DiffusionProcessor
+from embedding_cache import read_prompts
 from settings import Settings
 from settings_api import SettingsAPI
 from osc_settings_controller import OscSettingsController
+import socket_factory
 
 def unpack_rgb444_image(buffer, image_shape):
     mask = (2<<10) - 1
@@ -65,15 +67,12 @@ class Receiver(ThreadedWorker):
         self.batch_size = batch_size
         
     def setup(self):
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.SUB)
+        self.sock = socket_factory.socket(zmq.SUB, rcvhwm=1)
         address = f"ipc:///tmp/zmq"
         print(f"Connecting to {address}")
         self.sock.connect(address)
         self.sock.setsockopt(zmq.SUBSCRIBE, b"")
         self.sock.setsockopt(zmq.RCVTIMEO, 100)
-        self.sock.setsockopt(zmq.RCVHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
         self.batch = []
         self.settings_batch = []
         self.jpeg = TurboJPEG()
@@ -119,7 +118,6 @@ class Receiver(ThreadedWorker):
         
     def cleanup(self):
         self.sock.close()
-        self.context.term()
 
 def get_texture_size(texture):
     w = ctypes.c_int()
@@ -134,7 +132,14 @@ class Processor(ThreadedWorker):
         self.settings = settings
         
     def setup(self):
-        self.diffusion_processor = DiffusionProcessor()
+        prewarm_prompts = None
+        if self.settings.prewarm_prompts:
+            prewarm_prompts = read_prompts(self.settings.prewarm_prompts)
+        self.diffusion_processor = DiffusionProcessor(
+            embedding_cache_size=self.settings.embedding_cache_size,
+            embedding_cache_dir=self.settings.embedding_cache_dir,
+            prewarm_prompts=prewarm_prompts,
+        )
         self.clear_input() # drop old frames
         self.runs = 0
         
@@ -148,7 +153,10 @@ class Processor(ThreadedWorker):
             use_compel=True,
             num_inference_steps=2,
             strength=0.7,
-            seed=self.settings.seed)
+            seed=self.settings.seed,
+            output="uint8",
+            blend_prompts=self.settings.blend_prompts,
+            blend_weights=self.settings.blend_weights)
         
         for frame_settings, image, result in zip(settings_batch, images, results):
             if frame_settings.opacity == 1:
@@ -156,7 +164,7 @@ class Processor(ThreadedWorker):
             else:
                 opacity = float(frame_settings.opacity)
                 input_image = np.transpose(image.cpu().numpy(), (1, 2, 0))[:result.shape[0]]
-                blended = result * opacity + input_image * (1 - opacity) 
+                blended = result * (opacity / 255) + input_image * (1 - opacity) 
                 self.output_queue.put(blended)
                 
         self.runs += 1
@@ -187,10 +195,6 @@ class Display(ThreadedWorker):
         self.clear_input() # drop old frames
     
     def work(self, frame):
-        while self.input_queue.qsize() > self.batch_size:
-            # print("dropping display frame")
-            frame = self.input_queue.get()
-        
         # Event handling
         while sdl2.SDL_PollEvent(ctypes.byref(self.event)):
             if self.event.type == sdl2.SDL_QUIT:
@@ -203,7 +207,9 @@ class Display(ThreadedWorker):
                     sdl2.SDL_SetWindowFullscreen(self.window.window, mode)
 
         # Update texture
-        image_data = (frame * 255).astype(np.uint8)
+        image_data = frame
+        if image_data.dtype != np.uint8: # blended frames are still float
+            image_data = (frame * 255).astype(np.uint8)
         height, width, channels = image_data.shape
         create_texture = False
         if self.texture is None:
@@ -231,12 +237,14 @@ class Display(ThreadedWorker):
         sdl2.ext.quit()
 
 settings = Settings()
+socket_factory.configure(settings)
 settings_api = SettingsAPI(settings)
 settings_controller = OscSettingsController(settings)
 
 receiver = Receiver(settings.batch_size)
-processor = Processor(settings).feed(receiver)
-display = Display(settings.batch_size).feed(processor)
+processor = Processor(settings).feed(receiver, settings.queue_size, settings.queue_policy)
+# only keep the most recent batch of frames for display
+display = Display(settings.batch_size).feed(processor, settings.batch_size, "drop_oldest")
 
 settings_api.start()
 settings_controller.start()
@@ -0,0 +1,79 @@
+import os
+import time
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+turbojpeg = pytest.importorskip("turbojpeg")
+
+from camera_capture import FileCapture, LatestFrameGrabber, lossless_crop, MCU_SIZE
+
+
+@pytest.fixture
+def frames(tmp_path):
+    for i in range(3):
+        img = np.full((48, 64, 3), i * 80, dtype=np.uint8)
+        cv2.imwrite(os.path.join(tmp_path, f"{i:06d}.jpg"), img)
+    return str(tmp_path)
+
+
+def test_file_capture_mjpeg(frames):
+    capture = FileCapture(frames, fps=1000, mjpeg=True)
+    jpgs = [bytes(capture.read()) for i in range(4)]
+    capture.release()
+    assert all(e[:2] == b"\xff\xd8" for e in jpgs)
+    # loops back to the first frame
+    assert jpgs[3] == jpgs[0]
+
+
+def test_file_capture_decode(frames):
+    capture = FileCapture(frames, fps=1000, mjpeg=False)
+    frame = capture.read()
+    capture.release()
+    assert frame.shape == (48, 64, 3)
+
+
+def test_latest_frame_grabber(frames):
+    grabber = LatestFrameGrabber(FileCapture(frames, fps=200, mjpeg=False))
+    latest = grabber.get(timeout=1)
+    grabber.close()
+    assert latest is not None
+    timestamp, frame = latest
+    assert frame.shape == (48, 64, 3)
+
+
+class FailingCapture:
+    def __init__(self):
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        raise OSError("camera unplugged")
+
+    def release(self):
+        pass
+
+
+def test_grabber_survives_read_errors():
+    capture = FailingCapture()
+    grabber = LatestFrameGrabber(capture)
+    time.sleep(0.3)
+    assert grabber.thread.is_alive()
+    assert grabber.get(timeout=0.01) is None
+    grabber.close()
+    # backs off instead of spinning
+    assert 1 < capture.reads < 10
+
+
+def test_lossless_crop(frames):
+    jpeg = turbojpeg.TurboJPEG()
+    with open(os.path.join(frames, "000001.jpg"), "rb") as f:
+        encoded = f.read()
+    _, _, subsample, _ = jpeg.decode_header(encoded)
+    mcu_width, mcu_height = MCU_SIZE[subsample]
+    # the crop moves to the mcu grid, and is clipped to the image
+    cropped = lossless_crop(jpeg, encoded, 20, 3, 64, 64)
+    x = 20 - 20 % mcu_width
+    y = 3 - 3 % mcu_height
+    assert jpeg.decode_header(cropped)[:2] == (64 - x, 48 - y)
+    assert jpeg.decode(cropped).shape == (48 - y, 64 - x, 3)
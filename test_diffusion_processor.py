@@ -0,0 +1,136 @@
+import types
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from diffusion_processor import DiffusionProcessor
+from pipelined_executor import PipelinedExecutor
+from pinned_buffers import PinnedBufferPool
+from shape_buckets import ShapeBuckets
+
+
+# an identity vae, AutoencoderTiny returns the latents without a distribution
+class StandInVae:
+    config = types.SimpleNamespace(scaling_factor=1.0)
+
+    def encode(self, images):
+        assert not torch.is_grad_enabled()
+        return types.SimpleNamespace(latents=images.float())
+
+    def decode(self, latents, return_dict=True):
+        assert not torch.is_grad_enabled()
+        return (latents,)
+
+
+# returns the input images, like a model with strength 0. with latents as
+# the image and output_type "latent", it returns the latents.
+class StandInPipe:
+    def __init__(self):
+        self.vae = StandInVae()
+
+    def __call__(self, image, output_type="pil", **kwargs):
+        images = image.float()
+        if output_type == "np":
+            images = images.permute(0, 2, 3, 1).numpy()
+        return types.SimpleNamespace(images=images)
+
+
+# the parts of load() that run() needs, without a model
+def stand_in_processor(pipe=None):
+    processor = DiffusionProcessor(lazy=True, device="cpu")
+    processor.pipe = pipe or StandInPipe()
+    processor.generator = torch.manual_seed(0)
+    processor.output_buffers = PinnedBufferPool(pin=False)
+    return processor
+
+
+def random_images(shape):
+    return np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+
+
+def run(processor, images, **kwargs):
+    return processor.run(
+        images,
+        prompt="a cat",
+        num_inference_steps=2,
+        strength=0.5,
+        output="uint8",
+        **kwargs
+    )
+
+
+def test_uint8_round_trip():
+    processor = stand_in_processor()
+    images = random_images((2, 8, 16, 3))
+    results = run(processor, images)
+    assert isinstance(results, np.ndarray)
+    assert results.dtype == np.uint8
+    # float16 keeps every uint8 value exactly
+    np.testing.assert_array_equal(results, images)
+
+
+def test_output_buffers_are_reused():
+    processor = stand_in_processor()
+    images = random_images((2, 8, 16, 3))
+    run(processor, images)
+    run(processor, images)
+    assert len(processor.output_buffers.buffers) == 1
+
+
+def test_bucket_crop():
+    processor = stand_in_processor()
+    processor.buckets = ShapeBuckets([(2, 8, 8)])
+    processor.buckets.warm.add((2, 8, 8))
+    images = random_images((1, 6, 10, 3))
+    results = run(processor, images)
+    # padded to 8 rows and center cropped to 8 columns, then the padding is removed
+    assert results.shape == (1, 6, 8, 3)
+    np.testing.assert_array_equal(results, images[:, :, 1:9])
+
+
+def test_bucket_split():
+    processor = stand_in_processor()
+    processor.buckets = ShapeBuckets([(2, 8, 8)])
+    processor.buckets.warm.add((2, 8, 8))
+    images = random_images((3, 8, 8, 3))
+    results = run(processor, images)
+    np.testing.assert_array_equal(results, images)
+
+
+def pipelined_processor():
+    processor = stand_in_processor()
+    stages = [processor.encode_stage, processor.denoise_stage, processor.decode_stage]
+    processor.executor = PipelinedExecutor(stages, "cpu")
+    return processor
+
+
+def run_async(processor, images):
+    return processor.run_async(
+        images,
+        prompt="a cat",
+        num_inference_steps=2,
+        strength=0.5,
+        output="uint8",
+    )
+
+
+def test_pipelined_round_trip():
+    processor = pipelined_processor()
+    batches = [random_images((2, 8, 16, 3)) + i for i in range(4)]
+    futures = [run_async(processor, images) for images in batches]
+    for future, images in zip(futures, batches):
+        # each result is copied, the output buffers are reused
+        np.testing.assert_array_equal(future.result(timeout=5).copy(), images)
+    processor.executor.close()
+
+
+def test_pipelined_bucket_split():
+    processor = pipelined_processor()
+    processor.buckets = ShapeBuckets([(2, 8, 8)])
+    processor.buckets.warm.add((2, 8, 8))
+    images = random_images((3, 6, 10, 3))
+    results = run_async(processor, images).result(timeout=5)
+    assert results.shape == (3, 6, 8, 3)
+    np.testing.assert_array_equal(results, images[:, :, 1:9])
+    processor.executor.close()
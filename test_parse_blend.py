@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from diffusion_processor import parse_blend
+
+
+def test_two_prompts():
+    assert parse_blend('("a cat", "a dog").blend(0.30, 0.70)') == (
+        ("a cat", "a dog"),
+        (0.3, 0.7),
+    )
+
+
+def test_n_prompts():
+    # the string OscSettingsController.set_blend writes
+    prompt = '("a", "b, with a comma", "c").blend(0.20, 0.30, 0.50)'
+    assert parse_blend(prompt) == (("a", "b, with a comma", "c"), (0.2, 0.3, 0.5))
+
+
+def test_not_a_blend():
+    assert parse_blend("a cat") is None
+    assert parse_blend('("a", "b").blend(0.5)') is None
+    assert parse_blend('("a", "b").blend(x, y)') is None
@@ -0,0 +1,53 @@
+import time
+import random
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelined_executor import PipelinedExecutor, gather
+
+
+# a fake pipeline on the cpu, with stages that take a random time
+def fake_stage(name, log):
+    def stage(item):
+        time.sleep(random.random() * 0.01)
+        log.append((name, item[0]))
+        return (item[0], item[1] + [name])
+    return stage
+
+
+def test_items_finish_in_order():
+    log = []
+    stages = [fake_stage(e, log) for e in ["encode", "denoise", "decode"]]
+    executor = PipelinedExecutor(stages, device="cpu")
+    futures = [executor.submit((i, [])) for i in range(20)]
+    results = [future.result(timeout=5) for future in futures]
+    executor.close()
+    assert results == [(i, ["encode", "denoise", "decode"]) for i in range(20)]
+    # each stage sees the items in submission order
+    for name in ["encode", "denoise", "decode"]:
+        assert [i for e, i in log if e == name] == list(range(20))
+    # and different items were in different stages at the same time
+    assert log != sorted(log, key=lambda e: e[1])
+
+
+def test_stage_error_fails_only_its_item():
+    def fail_on_odd(item):
+        if item % 2:
+            raise ValueError(item)
+        return item
+
+    executor = PipelinedExecutor([fail_on_odd, lambda item: item * 10], device="cpu")
+    futures = [executor.submit(i) for i in range(4)]
+    assert futures[0].result(timeout=5) == 0
+    assert futures[2].result(timeout=5) == 20
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    executor.close()
+
+
+def test_gather_combines_in_order():
+    executor = PipelinedExecutor([lambda item: item + 1], device="cpu")
+    futures = [executor.submit(i) for i in range(3)]
+    assert gather(futures, list).result(timeout=5) == [1, 2, 3]
+    executor.close()
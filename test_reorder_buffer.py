@@ -0,0 +1,47 @@
+from reorder_buffer import ReorderBuffer
+
+
+def test_in_order():
+    buffer = ReorderBuffer(8)
+    for index in range(20):
+        assert buffer.put(index, index, index)
+        assert buffer.pop(index) == index
+    assert len(buffer) == 0
+
+
+def test_reordered():
+    buffer = ReorderBuffer(8)
+    for index in [1, 2, 0]:
+        buffer.put(index, index, 0)
+    assert [buffer.pop(i) for i in range(3)] == [0, 1, 2]
+    assert len(buffer) == 0
+
+
+def test_jump_then_in_order():
+    buffer = ReorderBuffer(8)
+    next_index = 3
+    # 3 and 4 are missing when the stream jumps ahead
+    buffer.put(5, 5, next_index)
+    buffer.put(6, 6, next_index)
+    next_index = 20
+    buffer.discard_before(next_index)
+    assert len(buffer) == 0
+    for index in range(next_index, next_index + 30):
+        assert buffer.put(index, index, next_index)
+        assert buffer.pop(next_index) == index
+        next_index += 1
+    assert len(buffer) == 0
+
+
+def test_stale_slots_are_pruned():
+    buffer = ReorderBuffer(8)
+    buffer.put(2, 2, 0)
+    buffer.put(5, 5, 0)
+    # a skipped gap moves past 2 without discard_before
+    assert buffer.next_after(4) == 5
+    assert len(buffer) == 1
+    assert 2 not in buffer
+    # an old index left in the slot is dropped by pop
+    buffer.put(3, 3, 3)
+    assert buffer.pop(11) is None
+    assert len(buffer) == 1
@@ -0,0 +1,103 @@
+import os
+import types
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("natsort")
+
+from metrics import metrics
+from threaded_sequence import ThreadedSequence
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += duration
+
+
+def make_sequence(tmp_path, frames, catchup="drop", fps=4):
+    for i in range(frames):
+        with open(os.path.join(tmp_path, f"{i:06d}.jpg"), "wb") as f:
+            f.write(str(i).encode())
+    settings = types.SimpleNamespace(
+        directory=str(tmp_path),
+        fps=fps,
+        catchup=catchup,
+        batch_size=1,
+        prefetch_frames=4,
+        prefetch_cache=16,
+        prefetch_all=False,
+    )
+    clock = FakeClock()
+    sequence = ThreadedSequence(settings, clock, clock.sleep)
+    sequence.setup()
+    sequence.playing.set()
+    return sequence, clock
+
+
+def play(sequence, n):
+    frames = []
+    for i in range(n):
+        timestamp, index, encoded = sequence.work()
+        assert bytes(encoded) == str(index).encode()
+        frames.append(index)
+    return frames
+
+
+def counter(sequence, name):
+    return metrics.counters.get((sequence.name, name, None), 0)
+
+
+def test_on_time(tmp_path):
+    sequence, clock = make_sequence(tmp_path, 8)
+    assert play(sequence, 4) == [0, 1, 2, 3]
+    assert clock.now == 1.0
+    sequence.close()
+
+
+def test_drop_skips_to_the_timeline(tmp_path):
+    sequence, clock = make_sequence(tmp_path, 8, "drop")
+    dropped = counter(sequence, "dropped_frames")
+    assert play(sequence, 2) == [0, 1]
+    # stall for four frames
+    clock.now += 1.0
+    assert play(sequence, 2) == [5, 6]
+    assert counter(sequence, "dropped_frames") - dropped == 3
+    # still on the original timeline
+    assert clock.now == 7 / 4
+    sequence.close()
+
+
+def test_slow_plays_every_frame(tmp_path):
+    sequence, clock = make_sequence(tmp_path, 8, "slow")
+    late = counter(sequence, "late_frames")
+    assert play(sequence, 2) == [0, 1]
+    clock.now += 1.0
+    assert play(sequence, 2) == [2, 3]
+    assert counter(sequence, "late_frames") - late == 1
+    # the timeline moved back by the stall
+    assert clock.now == 1.5 + 1 / 4
+    sequence.close()
+
+
+def test_wrap_around(tmp_path):
+    sequence, clock = make_sequence(tmp_path, 3)
+    assert play(sequence, 7) == [0, 1, 2, 0, 1, 2, 0]
+    # looping doesn't lose or gain time
+    assert clock.now == 7 / 4
+    sequence.close()
+
+
+def test_drop_wraps_around(tmp_path):
+    sequence, clock = make_sequence(tmp_path, 3, "drop")
+    assert play(sequence, 1) == [0]
+    clock.now += 1.0
+    # the fifth frame on the timeline is frame 1 of the second loop
+    assert play(sequence, 2) == [1, 2]
+    assert clock.now == 6 / 4
+    sequence.close()
@@ -1,38 +1,54 @@
 import time
-import cv2
 from turbojpeg import TurboJPEG
 from threaded_worker import ThreadedWorker
+from camera_capture import CameraCapture, FileCapture, LatestFrameGrabber, lossless_crop
 
+# camera_mode "decode" decodes to pixels, crops and encodes again,
+# "crop" crops the camera's mjpeg losslessly without decoding, and
+# "passthrough" forwards the camera's mjpeg untouched.
+# camera_source plays a directory of jpgs instead of the camera.
 class ThreadedCamera(ThreadedWorker):
-    def __init__(self):
+    def __init__(self, settings):
         super().__init__(has_input=False)
+        self.settings = settings
         self.jpeg = TurboJPEG()
-        self.cap = cv2.VideoCapture(-1, cv2.CAP_V4L2)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
-        self.cap.set(cv2.CAP_PROP_FPS, 30)
+        mjpeg = settings.camera_mode != "decode"
+        if settings.camera_source:
+            self.capture = FileCapture(settings.camera_source, settings.fps, mjpeg)
+        else:
+            self.capture = CameraCapture(1920, 1080, 30, mjpeg)
 
     def setup(self):
         self.start_time = time.time()
         self.frame_number = 0
-        
+        self.grabber = LatestFrameGrabber(self.capture, self.name)
+
     def work(self):
-        timestamp = time.time()
+        latest = self.grabber.get()
+        if latest is None:
+            return
+        self.begin_work()
+        timestamp, frame = latest
         self.frame_number += 1
         # if self.frame_number % 30 == 0:
         #     duration = time.time() - self.start_time
         #     fps = self.frame_number / duration
         #     print(f"fps {fps:.2f}")
-        
-        ret, frame = self.cap.read()
-        
+
+        mode = self.settings.camera_mode
+        if mode == "passthrough":
+            return timestamp, self.frame_number, frame
+
         # crop to the center 1024x1024
+        if mode == "crop":
+            encoded = lossless_crop(self.jpeg, frame, 448, 28, 1024, 1024)
+            return timestamp, self.frame_number, encoded
+
         frame = frame[28:1052, 448:1472]
-        
+
         # print(frame.shape)
         encoded = self.jpeg.encode(frame)
         return timestamp, self.frame_number, encoded
-        
+
     def cleanup(self):
-        self.cap.release()
\ No newline at end of file
+        self.grabber.close()
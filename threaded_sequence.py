@@ -1,66 +1,157 @@
-import time
 import os
+import time
 import threading
 import queue
-from natsort import natsorted
 from threaded_worker import ThreadedWorker
+from metrics import metrics
+from sequence_pack import open_sequence
+from frame_prefetcher import FramePrefetcher
 
+# frames are scheduled on a monotonic clock from start_time, so the playback
+# stays locked to fps. clock and sleep can be replaced for testing.
 class ThreadedSequence(ThreadedWorker):
-    def __init__(self, settings):
+    def __init__(self, settings, clock=time.monotonic, sleep=time.sleep):
         super().__init__(has_input=False)
         self.settings = settings
-        self.fns = natsorted(os.listdir(settings.directory))
+        self.clock = clock
+        self.sleep = sleep
+        # indexed sequences by directory, reused when switching back
+        self.sequences = {}
+        # outdated sequences, closed once no prefetcher reads them anymore
+        self.retired = []
+        self.directory = settings.directory
+        self.sequence, self.prefetcher = self.open_source(self.directory)
+        self.loading = None
+        self.next_source = None
         self.playing = threading.Event()
         self.scrub_queue = queue.Queue()
+
+    def open_source(self, directory):
+        # a packed file next to the directory takes precedence, see open_sequence
+        fn = directory.rstrip("/") + ".seq"
+        mtime = os.stat(fn if os.path.isfile(fn) else directory).st_mtime
+        cached = self.sequences.get(directory)
+        if cached is None or cached[0] != mtime:
+            print(self.name, "indexing", directory)
+            self.sequences[directory] = (mtime, open_sequence(directory, self.settings.fps))
+            if cached is not None:
+                # it may still be playing, switch_source closes it
+                self.retired.append(cached[1])
+        sequence = self.sequences[directory][1]
+        cache_size = self.settings.prefetch_cache
+        if self.settings.prefetch_all:
+            cache_size = len(sequence)
+        prefetcher = FramePrefetcher(
+            sequence, self.settings.prefetch_frames, cache_size, self.name
+        )
+        return sequence, prefetcher
+
+    # indexes and prefetches the new source off the frame thread, work()
+    # swaps to it at the next frame
+    def load_source(self, directory):
+        try:
+            sequence, prefetcher = self.open_source(directory)
+            prefetcher.wait(self.settings.batch_size * 2)
+            self.next_source = (directory, sequence, prefetcher)
+        except (OSError, ValueError) as e:
+            print(self.name, "could not open", directory, e)
+            self.next_source = (directory, None, None)
+
+    def switch_source(self):
+        if self.settings.directory != self.directory and self.loading is None:
+            self.loading = threading.Thread(
+                target=self.load_source, args=(self.settings.directory,), daemon=True
+            )
+            self.loading.start()
+        if self.next_source is None:
+            return
+        directory, sequence, prefetcher = self.next_source
+        self.next_source = None
+        self.loading = None
+        self.directory = directory
+        if sequence is None:
+            return
+        print(self.name, "switching to", directory)
+        self.prefetcher.close()
+        self.sequence, self.prefetcher = sequence, prefetcher
+        self.frame_number = 0
+        self.start_time = self.clock()
+        self.close_retired()
+
+    def close_retired(self):
+        retired, self.retired = self.retired, []
+        for sequence in retired:
+            sequence.close()
         
     def setup(self):
-        self.start_time = time.time()
+        self.start_time = self.clock()
         self.frame_number = 0
         
     def read_scrub(self):
         while not self.scrub_queue.empty():
             self.frame_number = self.scrub_queue.get()
             timestamp = self.frame_number / self.settings.fps
-            self.start_time = time.time() - timestamp
+            self.start_time = self.clock() - timestamp
         
     def work(self):
         self.playing.wait()
         if self.should_exit:
             return
         
+        self.switch_source()
         self.read_scrub()
         
-        timestamp = time.time()
-        
+        fps = self.settings.fps
         index = self.frame_number
         
-        next_frame_time = self.start_time + (index + 1) / self.settings.fps
-        sleep_time = next_frame_time - time.time()
+        next_frame_time = self.start_time + (index + 1) / fps
+        late = self.clock() - next_frame_time
+        if late > 1 / fps:
+            metrics.count(self.name, "late_frames")
+            if self.settings.catchup == "drop":
+                # skip the frames we missed and stay on the original timeline
+                skip = int(late * fps)
+                metrics.count(self.name, "dropped_frames", skip)
+                index = self.wrap(index + skip)
+                next_frame_time = self.start_time + (index + 1) / fps
+            else:
+                # play every frame and move the timeline back
+                self.start_time += late
+                next_frame_time += late
+        sleep_time = next_frame_time - self.clock()
         if sleep_time > 0:
-            time.sleep(sleep_time)
+            self.sleep(sleep_time)
+        self.begin_work()
             
-        fn = os.path.join(self.settings.directory, self.fns[index])
-        with open(fn, "rb") as f:
-            encoded = f.read()
-            
-        self.frame_number += 1
-        if self.frame_number == len(self.fns):
-            self.frame_number = 0
-            self.start_time = time.time()
+        timestamp = time.time()
+        encoded = self.prefetcher.get(index)
+        self.frame_number = self.wrap(index + 1)
             
         return timestamp, index, encoded
+
+    # loops back to the start without losing time on the clock
+    def wrap(self, frame_number):
+        n = len(self.sequence)
+        if frame_number >= n:
+            self.start_time += (frame_number // n) * n / self.settings.fps
+            frame_number %= n
+        return frame_number
     
     def close(self):
         self.should_exit = True
         self.playing.set()
         super().close()
+        self.prefetcher.close()
+        self.close_retired()
+        for mtime, sequence in self.sequences.values():
+            sequence.close()
     
     def play(self):
         print("playing")
         if self.playing.is_set():
             return
         self.read_scrub()
-        self.scrub(self.frame_number / len(self.fns))
+        self.scrub(self.frame_number / len(self.sequence))
         self.playing.set()
         
     def pause(self):
@@ -68,5 +159,7 @@ class ThreadedSequence(ThreadedWorker):
         self.playing.clear()
         
     def scrub(self, pct):
-        frame = int(pct * len(self.fns))
+        frame = int(pct * len(self.sequence))
+        # start reading the target region before playback gets there
+        self.prefetcher.seek(frame)
         self.scrub_queue.put(frame)
\ No newline at end of file
@@ -2,36 +2,87 @@ import multiprocessing
 import threading
 import queue
 import time
+import collections
+from metrics import metrics, ExportSlot
+from bounded_queue import BoundedQueue
+from shared_memory_queue import SharedMemoryQueue
 
 
 class ThreadedWorker:
-    def __init__(self, has_input=True, has_output=True, mode="thread", debug=False):
+    def __init__(
+        self,
+        has_input=True,
+        has_output=True,
+        mode="thread",
+        debug=False,
+        queue_size=0,
+        queue_policy="block",
+    ):
+        self.mode = mode
         if mode == "thread":
             self.ParallelClass = threading.Thread
-            self.QueueClass = queue.Queue
+            self.QueueClass = BoundedQueue
+            self.exit_event = threading.Event()
         elif mode == "process":
-            self.ParallelClass = multiprocessing.Process
-            self.QueueClass = multiprocessing.Queue
+            # stages in process mode create their sockets in setup(), after the fork
+            context = multiprocessing.get_context("fork")
+            self.ParallelClass = context.Process
+            self.QueueClass = SharedMemoryQueue
+            self.exit_event = context.Event()
+        else:
+            raise ValueError(f"unknown mode {mode}")
         if has_input:
-            self.input_queue = self.QueueClass()
+            self.input_queue = self.QueueClass(queue_size, queue_policy)
         if has_output:
-            self.output_queue = self.QueueClass()
-        self.should_exit = False
+            self.output_queue = self.QueueClass(queue_size, queue_policy)
         self.parallel = self.ParallelClass(target=self.run)
         self.name = self.__class__.__name__
+        if mode == "process":
+            self.metrics_slot = ExportSlot(context)
+            metrics.attach(self.metrics_slot)
         
         self.debug = debug
         self.last_print = time.time()
         self.print_interval = 1
-        self.durations = []
+        self.durations = collections.deque(maxlen=10)
+        self.input_timeout = 0.1
+
+    # backed by an event so it is visible across processes in process mode
+    @property
+    def should_exit(self):
+        return self.exit_event.is_set()
+
+    @should_exit.setter
+    def should_exit(self, value):
+        if value:
+            self.exit_event.set()
+        else:
+            self.exit_event.clear()
 
     def set_name(self, name):
         self.name = name
         return self
 
-    def feed(self, feeder):
+    # queue_size and queue_policy replace the queue between feeder and self
+    def feed(self, feeder, queue_size=None, queue_policy=None):
         print(self.name, "feeding with", feeder.name)
+        output_queue = feeder.output_queue
+        # a thread feeding a process needs a queue that crosses processes
+        cross_process = self.mode == "process" and feeder.mode == "thread"
+        if cross_process or queue_size is not None or queue_policy is not None:
+            if queue_size is None:
+                queue_size = output_queue.maxsize
+            if queue_policy is None:
+                queue_policy = output_queue.policy
+            QueueClass = SharedMemoryQueue if "process" in (self.mode, feeder.mode) else BoundedQueue
+            if isinstance(output_queue, SharedMemoryQueue):
+                output_queue.unlink()
+            feeder.output_queue = QueueClass(queue_size, queue_policy)
+        if isinstance(self.input_queue, SharedMemoryQueue):
+            self.input_queue.unlink()
         self.input_queue = feeder.output_queue
+        self.input_queue.name = f"{feeder.name}->{self.name}"
+        metrics.register_queue(self.input_queue)
         return self
 
     def start(self):
@@ -46,8 +97,16 @@ class ThreadedWorker:
         pass
     
     def clear_input(self):
-        with self.input_queue.mutex:
-            self.input_queue.queue.clear()
+        self.input_queue.clear()
+
+    # called when no input arrived within input_timeout
+    def idle(self):
+        pass
+
+    # stages without input call this once they have something to do, after
+    # polling or sleeping, so the work histogram leaves out the wait
+    def begin_work(self):
+        self.work_start = time.time()
 
     # called before the parallel is joined
     def cleanup(self):
@@ -55,6 +114,9 @@ class ThreadedWorker:
 
     def run(self):
         print(self.name, "running")
+        if self.mode == "process":
+            # drop the histograms inherited from the parent
+            metrics.reset()
         self.setup()
         try:
             while not self.should_exit:
@@ -62,39 +124,65 @@ class ThreadedWorker:
                 cur_time = time.time()
                 if hasattr(self, "input_queue"):
                     try:
-                        input = self.input_queue.get(timeout=0.1)
+                        input = self.input_queue.get(timeout=self.input_timeout)
                     except queue.Empty:
+                        result = self.idle()
+                        if result is not None and hasattr(self, "output_queue"):
+                            self.output_queue.put(result)
                         continue
                     if input is None:
                         break
+                    metrics.observe(self.name, "queue_wait", self.input_queue.last_wait)
                     start_time = time.time()
                     result = self.work(input)
                 else:
+                    self.work_start = None
                     start_time = time.time()
                     result = self.work()
-                duration = time.time() - start_time
+                    if self.work_start is not None:
+                        start_time = self.work_start
+                    elif result is None:
+                        # an idle poll, nothing to measure
+                        start_time = None
+                if start_time is not None:
+                    duration = time.time() - start_time
+                    metrics.observe(self.name, "work", duration)
+                    self.durations.append(duration)
                 
                 if result is not None and hasattr(self, "output_queue"):
                     self.output_queue.put(result)
                     
-                self.durations.append(duration)
-                if len(self.durations) > 10:
-                    self.durations.pop(0)
-                    
                 time_since_print = cur_time - self.last_print
-                if self.debug and time_since_print > self.print_interval:
-                    duration = sum(self.durations) / len(self.durations)
-                    print(self.name, f"{duration*1000:.2f}ms", flush=True)
+                if time_since_print > self.print_interval:
+                    if self.mode == "process":
+                        self.metrics_slot.put(metrics.export())
+                    if self.debug:
+                        self.print_debug()
                     self.last_print = cur_time
                 
         except KeyboardInterrupt:
             print(self.name, "interrupted")
         self.cleanup()
 
+    def print_debug(self):
+        if not self.durations:
+            return
+        duration = sum(self.durations) / len(self.durations)
+        work = metrics.histogram(self.name, "work")
+        text = f"{duration*1000:.2f}ms p95 {work.percentile(0.95)*1000:.2f}ms"
+        if hasattr(self, "input_queue"):
+            stats = self.input_queue.stats()
+            text += f" queue {stats['size']}/{stats['maxsize']}"
+            text += f" high {stats['high_water']} drops {stats['drops']}"
+        print(self.name, text, flush=True)
+
     def close(self):
         print(self.name, "closing")
         self.should_exit = True
         if hasattr(self, "input_queue"):
-            self.input_queue.put(None)
+            try:
+                self.input_queue.put(None, block=False)
+            except queue.Full:
+                pass # the worker also exits on should_exit
         if self.parallel.is_alive():
             self.parallel.join()
@@ -3,6 +3,7 @@ import cv2
 import zmq
 from turbojpeg import TurboJPEG
 from threaded_worker import ThreadedWorker
+import socket_factory
 
 class ThreadedCamera(ThreadedWorker):
     def __init__(self):
@@ -25,18 +26,14 @@ class ThreadedCamera(ThreadedWorker):
 class ZmqSender(ThreadedWorker):
     def __init__(self):
         super().__init__(has_input=True)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PUB)
+        self.sock = socket_factory.socket(zmq.PUB, sndhwm=1)
         self.sock.bind(f"ipc:///tmp/zmq")
-        self.sock.setsockopt(zmq.SNDHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
       
     def work(self, encoded):
         self.sock.send(encoded)
         
     def cleanup(self):
         self.sock.close()
-        self.context.term()
         
 if __name__ == "__main__":
     camera = ThreadedCamera()
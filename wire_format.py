@@ -0,0 +1,32 @@
+import msgpack
+
+# version 1 packs everything into a single msgpack message.
+# version 2 sends a small msgpack header followed by one zmq frame per
+# jpg, so the payloads can be sent and received without copies.
+# receivers accept both, senders pick one with settings.wire_format.
+
+
+def pack_job(header, frames, version=2):
+    if version == 1:
+        return [msgpack.packb({**header, "frames": frames})]
+    return [msgpack.packb({**header, "version": 2}), *frames]
+
+
+def unpack_job(parts):
+    header = msgpack.unpackb(parts[0].buffer)
+    if len(parts) > 1:
+        header["frames"] = [part.buffer for part in parts[1:]]
+    return header
+
+
+def pack_result(header, jpg, version=2):
+    if version == 1:
+        return [msgpack.packb({**header, "jpg": jpg})]
+    return [msgpack.packb({**header, "version": 2}), jpg]
+
+
+def unpack_result(parts):
+    header = msgpack.unpackb(parts[0].buffer)
+    if len(parts) > 1:
+        header["jpg"] = parts[1].buffer
+    return header
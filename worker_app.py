@@ -6,92 +6,302 @@ print(f"Starting worker #{settings.worker_id}")
 
 import zmq
 import msgpack
-import numpy as np
+import concurrent.futures
+import multiprocessing
+import threading
+import traceback
 import time
 from turbojpeg import TurboJPEG, TJPF_RGB
 from threaded_worker import ThreadedWorker
-from diffusion_processor import DiffusionProcessor
+from metrics import metrics
+from wire_format import unpack_job, pack_result
+from result_codec import ResultEncoder
+from pinned_buffers import PinnedBufferPool
+from diffusion_processor import DiffusionProcessor, STATES
+from embedding_cache import read_prompts
+from embedding_store import EmbeddingClient
+from frame_delta import StaticDetector, small_luma
+from zmq_receive import receive
+import socket_factory
+
+socket_factory.configure(settings)
+
+# finished jobs return their credit through a pipe, which works across
+# processes and can be polled together with the job socket
+class CreditPipe:
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.get_context("fork").Pipe(duplex=False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def put(self, credits):
+        self.writer.send_bytes(bytes([credits]))
+
+    # returns the credits sent since the last call
+    def drain(self):
+        credits = 0
+        while self.reader.poll():
+            credits += sum(self.reader.recv_bytes())
+        return credits
+
 
 class WorkerReceiver(ThreadedWorker):
-    def __init__(self, hostname, port):
-        super().__init__(has_input=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PULL)
+    def __init__(self, hostname, port, mode="thread", startup_state=None):
+        super().__init__(has_input=False, mode=mode)
+        self.address = f"tcp://{hostname}:{port}"
+        self.startup_state = startup_state
+        self.credit_pipe = None
+        if settings.dispatch == "credit":
+            # WorkerSender returns a credit here after each finished job
+            self.credit_pipe = CreditPipe()
+
+    def setup(self):
+        kind = zmq.DEALER if self.credit_pipe is not None else zmq.PULL
+        self.sock = socket_factory.socket(kind, rcvhwm=1)
         self.sock.setsockopt(zmq.RCVTIMEO, 100)
-        self.sock.setsockopt(zmq.RCVHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
-        address = f"tcp://{hostname}:{port}"
-        print(f"WorkerReceiver connecting to {address}")
-        self.sock.connect(address)
+        self.connected = False
+        # a refusing PULL socket would still queue jobs up to its HWM,
+        # so it only connects once the model is warm
+        if self.credit_pipe is not None or not self.refusing:
+            self.connect()
         self.jpeg = TurboJPEG()
+        # a forked process can't pin memory, and its frames are copied to
+        # shared memory anyway
+        self.buffers = PinnedBufferPool(pin=False if self.mode == "process" else None)
+        self.free = settings.worker_credits
+        self.received = 0
+        if self.credit_pipe is not None:
+            self.send_credits(hello=True)
+            # wakes up for a job or a returned credit
+            self.poller = zmq.Poller()
+            self.poller.register(self.sock, zmq.POLLIN)
+            self.poller.register(self.credit_pipe.fileno(), zmq.POLLIN)
+
+    def connect(self):
+        print(f"WorkerReceiver connecting to {self.address}")
+        self.sock.connect(self.address)
+        self.connected = True
+
+    @property
+    def state(self):
+        if self.startup_state is None:
+            return "warm"
+        return STATES[self.startup_state.value]
+
+    # a worker whose model failed to load takes no jobs whatever the policy
+    @property
+    def refusing(self):
+        if self.state == "failed":
+            return True
+        return settings.startup_policy == "refuse" and self.state != "warm"
+
+    # every message carries the absolute number of free slots and the number
+    # of jobs received so far, so a restarted server can pick up from any
+    # heartbeat. no slots are free until the model is warm, the server
+    # sends the jobs to the warm workers meanwhile.
+    def advertised_credits(self):
+        return self.free if self.state == "warm" else 0
+
+    def send_credits(self, hello=False):
+        self.advertised = self.advertised_credits()
+        msg = {
+            "worker_id": settings.worker_id,
+            "free": self.advertised,
+            "received": self.received,
+            "hello": hello,
+            "state": self.state,
+        }
+        self.sock.send(msgpack.packb(msg))
+        self.last_credit_time = time.time()
+
+    # return finished jobs as credits, and send a heartbeat when idle
+    def return_credits(self):
+        returned = self.credit_pipe.drain()
+        self.free += returned
+        changed = self.advertised_credits() != self.advertised
+        if returned > 0 or changed or time.time() - self.last_credit_time > 1:
+            self.send_credits()
+
+    # in credit mode, one poll covers the job socket and the credit pipe, so
+    # credits go back right away and an idle worker wakes up 10 times a second
+    def receive_job(self):
+        if self.credit_pipe is None:
+            return receive(self.sock, 0.1, multipart=True, copy=False)
+        events = dict(self.poller.poll(100))
+        self.return_credits()
+        if self.sock not in events:
+            return None
+        return self.sock.recv_multipart(copy=False)
 
     def work(self):
         while not self.should_exit:            
-            try:
-                msg = self.sock.recv(flags=zmq.NOBLOCK, copy=False).bytes
-                receive_time = time.time()
-                # print(int(time.time()*1000)%1000, "receiving")
-            except zmq.Again:
+            # in push mode, the connection decides whether jobs arrive at all
+            if self.credit_pipe is None:
+                if self.connected and self.state == "failed":
+                    # drop the jobs queued for us, the other workers take the rest
+                    print("WorkerReceiver disconnecting, the model failed to load")
+                    self.sock.disconnect(self.address)
+                    self.connected = False
+                if not self.connected:
+                    # leave the jobs to the other workers until the model is warm
+                    if self.refusing:
+                        time.sleep(0.1)
+                        continue
+                    self.connect()
+            parts = self.receive_job()
+            if parts is None:
                 continue
+            self.begin_work()
+            if self.credit_pipe is not None:
+                self.received += 1
+                self.free -= 1
             
             try:
-                unpacked = msgpack.unpackb(msg)
-                parameters = unpacked["parameters"]
-                images = []
-                for frame in unpacked["frames"]:
-                    img = self.jpeg.decode(frame, pixel_format=TJPF_RGB)
-                    images.append(img / 255)
-                unpacked["frames"] = images
+                unpacked = unpack_job(parts)
+                unpacked["frames"] = self.decode_batch(unpacked["frames"])
                 return unpacked
-            except OSError:
+            except (OSError, ValueError):
+                if self.credit_pipe is not None:
+                    self.credit_pipe.put(1)
                 continue
 
+    # all frames of a job share one reusable uint8 buffer, the processor
+    # normalizes the whole batch at once
+    def decode_batch(self, frames):
+        width, height, _, _ = self.jpeg.decode_header(frames[0])
+        _, images = self.buffers.get((len(frames), height, width, 3))
+        for i, frame in enumerate(frames):
+            images[i] = self.jpeg.decode(frame, pixel_format=TJPF_RGB)
+        return images
+
     def cleanup(self):
         self.sock.close()
-        self.context.term()
 
 
 class Processor(ThreadedWorker):
-    def __init__(self, settings):
+    def __init__(self, settings, startup_state=None):
         super().__init__()
+        self.startup_state = startup_state
         self.generator = None
         self.batch_count = 0
         warmup = None
         if settings.warmup:
             warmup = f"{settings.batch_size}x{settings.warmup}"
-        self.processor = DiffusionProcessor(warmup, settings.local_files_only)
+        prewarm_prompts = None
+        if settings.prewarm_prompts:
+            prewarm_prompts = read_prompts(settings.prewarm_prompts)
+        embedding_remote = None
+        if settings.embedding_broadcast:
+            address = f"tcp://{settings.primary_hostname}:{settings.embedding_port}"
+            embedding_remote = EmbeddingClient(address)
+        self.processor = DiffusionProcessor(
+            warmup,
+            settings.local_files_only,
+            settings.embedding_cache_size,
+            settings.embedding_cache_dir,
+            prewarm_prompts,
+            embedding_remote,
+            settings.shape_buckets,
+            settings.pipelined,
+            settings.compile_cache_dir,
+            lazy=True,
+            on_state=self.update_state,
+        )
+        self.static = StaticDetector()
+
+    def update_state(self, state):
+        if self.startup_state is not None:
+            self.startup_state.value = STATES.index(state)
+
+    # loads, compiles and warms up the model while jobs are already accepted
+    def load(self):
+        threading.Thread(target=self.load_model, daemon=True).start()
+
+    def load_model(self):
+        try:
+            self.processor.load()
+        except Exception:
+            # e.g. a missing model with local_files_only or bad shape buckets
+            traceback.print_exc()
+            self.processor.set_state("failed")
 
     def work(self, unpacked):
         start_time = time.time()
 
         images = unpacked["frames"]
         parameters = unpacked["parameters"]
+        luma = None
+        static = False
+        if parameters.get("static_reuse", False) and self.processor.ready and not parameters["passthrough"]:
+            luma = small_luma(images)
+            static = self.static.is_static(luma, parameters, parameters["static_threshold"])
 
-        if parameters["passthrough"]:
+        if parameters["passthrough"] or not self.processor.ready:
             results = images
+        elif static:
+            # the input barely changed since the last run
+            results = self.static.reuse(len(images))
+            metrics.count(self.name, "static_batches")
         else:
             seed = None
             if parameters["fixed_seed"]:
                 seed = parameters["seed"]
-            try:
-                results = self.processor.run(
-                    images,
-                    prompt=parameters["prompt"],
-                    num_inference_steps=parameters["num_inference_steps"],
-                    strength=parameters["strength"],
-                    use_compel=parameters["use_compel"],
-                    seed=seed
+            args = dict(
+                prompt=parameters["prompt"],
+                num_inference_steps=parameters["num_inference_steps"],
+                strength=parameters["strength"],
+                use_compel=parameters["use_compel"],
+                seed=seed,
+                output="uint8",
+                blend_prompts=parameters.get("blend_prompts"),
+                blend_weights=parameters.get("blend_weights"),
+            )
+            if settings.pipelined and settings.threaded:
+                # the next batch starts while this one is still on the gpu
+                future = self.processor.run_async(images, **args)
+                future.add_done_callback(
+                    lambda future: self.output_queue.put(
+                        self.finish(unpacked, future, start_time, luma)
+                    )
                 )
+                return
+            try:
+                results = self.processor.run(images, **args)
+                if luma is not None:
+                    self.static.update(luma, parameters, results)
             except:
                 results = images
 
+        return self.finish(unpacked, results, start_time, static=static)
+
+    def finish(self, unpacked, results, start_time, luma=None, static=False):
+        if isinstance(results, concurrent.futures.Future):
+            if results.exception() is None:
+                results = results.result()
+                if luma is not None:
+                    self.static.update(luma, unpacked["parameters"], results)
+            else:
+                print(self.name, "pipelined run failed, passing the input through:", repr(results.exception()))
+                results = unpacked["frames"]
+
         unpacked["frames"] = results
 
+        duration = time.time() - start_time
+        latency = time.time() - unpacked["job_timestamp"]
+        unpacked["diffusion_time"] = duration
+        diffusion = metrics.histogram(self.name, "diffusion")
+        if not static:
+            diffusion.observe(duration)
+        metrics.observe(self.name, "latency", latency)
+
         if self.batch_count % 10 == 0:
-            latency = time.time() - unpacked["job_timestamp"]
-            duration = time.time() - start_time
+            latency = metrics.histogram(self.name, "latency")
             print(
-                f"diffusion {int(duration*1000)}ms latency {int(latency*1000)}ms",
+                f"diffusion p50 {int(diffusion.percentile(0.5)*1000)}ms",
+                f"p95 {int(diffusion.percentile(0.95)*1000)}ms",
+                f"latency p50 {int(latency.percentile(0.5)*1000)}ms",
+                f"p95 {int(latency.percentile(0.95)*1000)}ms",
                 flush=True,
             )
         self.batch_count += 1
@@ -100,63 +310,104 @@ class Processor(ThreadedWorker):
 
 
 class WorkerSender(ThreadedWorker):
-    def __init__(self, hostname, port):
-        super().__init__(has_output=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PUSH)
-        self.sock.setsockopt(zmq.SNDHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
-        address = f"tcp://{hostname}:{port}"
-        print(f"WorkerSender connecting to {address}")
-        self.sock.connect(address)
-        self.jpeg = TurboJPEG()
+    def __init__(self, hostname, port, mode="thread", credit_pipe=None):
+        super().__init__(has_output=False, mode=mode)
+        self.address = f"tcp://{hostname}:{port}"
+        self.credit_pipe = credit_pipe
+
+    def setup(self):
+        self.sock = socket_factory.socket(zmq.PUSH, sndhwm=1)
+        print(f"WorkerSender connecting to {self.address}")
+        self.sock.connect(self.address)
+        self.encoder = ResultEncoder(settings.jpeg_min_quality)
+        self.pool = concurrent.futures.ThreadPoolExecutor(settings.encoder_threads)
 
     def work(self, unpacked):
         indices = unpacked["indices"]
         results = unpacked["frames"]
         job_timestamp = unpacked["job_timestamp"]
         frame_timestamps = unpacked["frame_timestamps"]
+        diffusion_time = unpacked.get("diffusion_time", 0)
+        # the server asks for an encoding, we fall back to jpeg if we can't
+        parameters = unpacked["parameters"]
+        encoding = parameters.get("result_encoding", "jpeg")
+        quality = parameters.get("jpeg_quality", 85)
+        backlog = self.input_queue.qsize()
 
-        msgs = []
-        for index, frame_timestamp, result in zip(indices, frame_timestamps, results):
-            img_u8 = (result * 255).astype(np.uint8)
-            
+        def encode(index, frame_timestamp, img_u8):
             if unpacked["debug"]:
                 x = index % img_u8.shape[1]
                 img_u8[:, x, :] = 255
             
-            jpg = self.jpeg.encode(img_u8, pixel_format=TJPF_RGB)
-            msg = msgpack.packb(
+            payload, encoding_header = self.encoder.encode(img_u8, encoding, quality, backlog)
+            return pack_result(
                 {
                     "job_timestamp": job_timestamp,
                     "frame_timestamp": frame_timestamp,
                     "index": index,
-                    "jpg": jpg,
                     "worker_id": settings.worker_id,
-                }
+                    "diffusion_time": diffusion_time,
+                    **encoding_header,
+                },
+                payload,
+                settings.wire_format,
             )
-            msgs.append(msg)
-            
-        for index, msg in zip(indices, msgs):
-            self.sock.send(msg)
+
+        # frames are encoded in parallel and sent as soon as each is ready,
+        # the server reorders them
+        futures = [
+            self.pool.submit(encode, index, frame_timestamp, result)
+            for index, frame_timestamp, result in zip(indices, frame_timestamps, results)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            self.sock.send_multipart(future.result(), copy=False)
+
+        if self.credit_pipe is not None:
+            self.credit_pipe.put(1)
         
     def cleanup(self):
+        self.pool.shutdown()
         print("WorkerSender push close")
         self.sock.close()
-        print("WorkerSender context term")
-        self.context.term()
 
 
+# jpeg decode and encode can run in their own processes to stay off the GIL
+stage_mode = "process" if settings.process_stages else "thread"
+
+# shared with the receiver, which may run in another process
+startup_state = multiprocessing.get_context("fork").Value("i", 0)
+
 # create from beginning to end
-receiver = WorkerReceiver(settings.primary_hostname, settings.job_start_port)
-processor = Processor(settings).feed(receiver)
-sender = WorkerSender(settings.primary_hostname, settings.job_finish_port).feed(processor)
+receiver = WorkerReceiver(
+    settings.primary_hostname,
+    settings.job_start_port,
+    stage_mode,
+    startup_state,
+)
+queue_args = (settings.queue_size, settings.queue_policy)
+if settings.dispatch == "credit":
+    # credits already bound the jobs in flight, and a dropped job would leak its credit
+    queue_args = (settings.worker_credits, "block")
+processor = Processor(settings, startup_state).feed(receiver, *queue_args)
+sender = WorkerSender(
+    settings.primary_hostname,
+    settings.job_finish_port,
+    stage_mode,
+    receiver.credit_pipe,
+).feed(processor, *queue_args)
 
 if settings.threaded:
     # start from end to beginning
     sender.start()
     processor.start()
     receiver.start()
+    # after the stage processes are forked, so they don't inherit cuda
+    processor.load()
+else:
+    sender.setup()
+    processor.setup()
+    receiver.setup()
+    processor.load()
 
 try:
     while True:
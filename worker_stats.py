@@ -0,0 +1,72 @@
+import time
+import multiprocessing
+
+# per-worker round trip and throughput estimates, kept in shared memory so
+# ReorderingReceiver can update them from its own process in process mode
+class WorkerStats:
+    def __init__(self, max_workers=64, alpha=0.1, timeout=2, window=1):
+        self.max_workers = max_workers
+        self.alpha = alpha
+        self.timeout = timeout
+        self.window = window
+        self.lock = multiprocessing.Lock()
+        self.round_trip_mean = multiprocessing.RawArray("d", max_workers)
+        self.round_trip_var = multiprocessing.RawArray("d", max_workers)
+        self.frame_rate = multiprocessing.RawArray("d", max_workers)
+        self.frame_count = multiprocessing.RawArray("d", max_workers)
+        self.window_start = multiprocessing.RawArray("d", max_workers)
+        self.last_seen = multiprocessing.RawArray("d", max_workers)
+
+    def observe(self, worker_id, round_trip, now=None):
+        if now is None:
+            now = time.time()
+        i = worker_id % self.max_workers
+        with self.lock:
+            if now - self.last_seen[i] > self.timeout:
+                # new or returning worker, start over
+                self.round_trip_mean[i] = round_trip
+                self.round_trip_var[i] = 0
+                self.frame_rate[i] = 0
+                self.frame_count[i] = 0
+                self.window_start[i] = now
+            else:
+                delta = round_trip - self.round_trip_mean[i]
+                self.round_trip_mean[i] += self.alpha * delta
+                self.round_trip_var[i] = (1 - self.alpha) * (
+                    self.round_trip_var[i] + self.alpha * delta * delta
+                )
+            self.frame_count[i] += 1
+            duration = now - self.window_start[i]
+            if duration > self.window:
+                rate = self.frame_count[i] / duration
+                if self.frame_rate[i] == 0:
+                    self.frame_rate[i] = rate
+                else:
+                    self.frame_rate[i] += self.alpha * (rate - self.frame_rate[i])
+                self.frame_count[i] = 0
+                self.window_start[i] = now
+            self.last_seen[i] = now
+
+    def active(self, now=None):
+        if now is None:
+            now = time.time()
+        return [
+            i
+            for i in range(self.max_workers)
+            if self.last_seen[i] > 0 and now - self.last_seen[i] < self.timeout
+        ]
+
+    def round_trip(self, worker_id):
+        return self.round_trip_mean[worker_id % self.max_workers]
+
+    def round_trip_std(self, worker_id):
+        return self.round_trip_var[worker_id % self.max_workers] ** 0.5
+
+    def throughput(self, worker_id):
+        return self.frame_rate[worker_id % self.max_workers]
+
+    def mean_round_trip(self, now=None):
+        workers = self.active(now)
+        if not workers:
+            return None
+        return sum(self.round_trip(i) for i in workers) / len(workers)
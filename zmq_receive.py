@@ -0,0 +1,19 @@
+import zmq
+
+# receive stages wait on a poll with a timeout instead of spinning on
+# NOBLOCK, so they use no cpu while idle. returns None on timeout.
+def receive(sock, timeout=0.1, multipart=False, copy=True):
+    if not sock.poll(int(timeout * 1000), zmq.POLLIN):
+        return None
+    try:
+        if multipart:
+            return sock.recv_multipart(flags=zmq.NOBLOCK, copy=copy)
+        return sock.recv(flags=zmq.NOBLOCK, copy=copy)
+    except zmq.Again:
+        return None
+
+
+# only keep the latest message. has to be set before connecting, and only
+# works with single part messages.
+def conflate(sock):
+    sock.setsockopt(zmq.CONFLATE, 1)
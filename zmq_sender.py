@@ -2,46 +2,128 @@ import time
 import msgpack
 import zmq
 from threaded_worker import ThreadedWorker
+from wire_format import pack_job
+import socket_factory
 
 
 class ZmqSender(ThreadedWorker):
-    def __init__(self, settings):
+    def __init__(self, settings, worker_stats=None):
         super().__init__(has_output=False)
-        self.context = zmq.Context()
-        self.sock = self.context.socket(zmq.PUSH)
-        self.sock.setsockopt(zmq.SNDHWM, 1)
-        self.sock.setsockopt(zmq.LINGER, 0)
+        if settings.dispatch == "credit":
+            # workers connect with DEALER sockets and announce free slots
+            self.sock = socket_factory.socket(zmq.ROUTER)
+            self.sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        else:
+            self.sock = socket_factory.socket(zmq.PUSH, sndhwm=1)
         self.sock.bind(f"tcp://0.0.0.0:{settings.job_start_port}")
         self.settings = settings
+        self.worker_stats = worker_stats
+        self.workers = {}
 
     def work(self, batch):
         frame_timestamps, indices, frames = zip(*batch)
         settings = self.settings
         job_timestamp = time.time()
-        packed = msgpack.packb(
+        parts = pack_job(
             {
                 "job_timestamp": job_timestamp,
                 "frame_timestamps": frame_timestamps,
                 "indices": indices,
-                "frames": frames,
                 "debug": settings.debug,
                 "parameters": {
                     "prompt": settings.prompt,
+                    "blend_prompts": settings.blend_prompts,
+                    "blend_weights": settings.blend_weights,
                     "num_inference_steps": settings.num_inference_steps,
                     "strength": settings.strength,
                     "seed": settings.seed,
                     "passthrough": settings.passthrough,
                     "fixed_seed": settings.fixed_seed,
-                    "use_compel": settings.compel
+                    "use_compel": settings.compel,
+                    "static_reuse": settings.static_reuse,
+                    "static_threshold": settings.static_threshold,
+                    "result_encoding": settings.result_encoding,
+                    "jpeg_quality": settings.jpeg_quality,
                 },
-            }
+            },
+            frames,
+            settings.wire_format,
         )
-        # frame = zmq.Frame(packed)
-        self.sock.send(packed)
+        if settings.dispatch == "credit":
+            self.dispatch(parts, indices)
+        else:
+            self.sock.send_multipart(parts, copy=False)
         # print(int(time.time()*1000)%1000, "sending")
-        # print("outgoing length", len(packed))
         # print("sending", indices)
 
+    def read_credits(self, timeout=0):
+        while self.sock.poll(int(timeout * 1000), zmq.POLLIN):
+            timeout = 0
+            identity, msg = self.sock.recv_multipart()
+            unpacked = msgpack.unpackb(msg)
+            worker = self.workers.get(identity)
+            if worker is None or unpacked.get("hello"):
+                print(self.name, f"worker {unpacked['worker_id']} joined")
+                # jobs sent before we knew the worker don't count against it
+                worker = {"worker_id": unpacked["worker_id"], "sent": unpacked["received"]}
+                self.workers[identity] = worker
+            # free slots as the worker sees them, minus the jobs still on the way
+            in_flight = worker["sent"] - unpacked["received"]
+            worker["credits"] = unpacked["free"] - in_flight
+            worker["last_seen"] = time.time()
+            state = unpacked.get("state", "warm")
+            if worker.get("state") != state:
+                print(self.name, f"worker {worker['worker_id']} {state}")
+                worker["state"] = state
+
+    def expected_round_trip(self, worker):
+        if self.worker_stats is None:
+            return 0
+        # unknown workers are tried first so they get measured
+        return self.worker_stats.round_trip(worker["worker_id"])
+
+    def choose_worker(self, waited):
+        now = time.time()
+        for identity, worker in list(self.workers.items()):
+            if now - worker["last_seen"] > self.settings.worker_timeout:
+                print(self.name, f"worker {worker['worker_id']} timed out")
+                del self.workers[identity]
+        known = [self.expected_round_trip(w) for w in self.workers.values()]
+        known = [e for e in known if e > 0]
+        fastest = min(known) if known else 0
+        available = [e for e in self.workers.items() if e[1]["credits"] > 0]
+        if not available:
+            return None
+        identity, worker = min(available, key=lambda e: self.expected_round_trip(e[1]))
+        # a slow worker is only used once waiting for a faster one
+        # would take longer than the slow worker's extra round trip
+        round_trip = self.expected_round_trip(worker)
+        if fastest > 0 and round_trip > self.settings.straggler_factor * fastest:
+            if waited < round_trip - fastest:
+                return None
+        return identity
+
+    def dispatch(self, parts, indices):
+        start_time = time.time()
+        while not self.should_exit:
+            self.read_credits()
+            waited = time.time() - start_time
+            identity = self.choose_worker(waited)
+            if identity is not None:
+                worker = self.workers[identity]
+                try:
+                    self.sock.send_multipart([identity, *parts], copy=False)
+                    worker["credits"] -= 1
+                    worker["sent"] += 1
+                    return
+                except zmq.ZMQError:
+                    print(self.name, f"worker {worker['worker_id']} is gone")
+                    del self.workers[identity]
+                    continue
+            if waited > self.settings.dispatch_timeout:
+                print(self.name, "no worker available, dropping", indices)
+                return
+            self.read_credits(timeout=0.01)
+
     def cleanup(self):
         self.sock.close()
-        self.context.term()